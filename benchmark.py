@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def default_settings():
+    # Every setting of the repo's config_param.py as source text, except the host, port and directory
+    # placeholders that are left blank there
+    settings = {}
+    with open(os.path.join(REPO_DIR, 'config_param.py'), encoding='utf-8') as config_file:
+        for line in config_file:
+            name, sep, value = line.partition('=')
+            name = name.strip()
+            if not sep or not name.isidentifier() or not value.strip() or not value.strip().strip('r"\' '):
+                continue
+            try:
+                compile(line, 'config_param.py', 'exec')
+            except SyntaxError:
+                continue
+            settings[name] = value.strip()
+    return settings
+
+
+class LocalCluster:
+    # One Name Node and N Data Nodes as local processes on ephemeral ports. Each process runs from its own
+    # directory under base_dir, holding the config_param.py it imports and its log
+    def __init__(self, num_data_nodes, settings=None, base_dir=None):
+        self.base_dir = base_dir or tempfile.mkdtemp(prefix='yadfs-bench-')
+        self.settings = dict(default_settings(), **(settings or {}))
+        self.name_node_port = None
+        self.name_node_url = None
+        self.name_node = None
+        self.data_nodes = [None] * num_data_nodes
+        self.data_node_ports = [free_port() for _ in range(num_data_nodes)]
+
+    def write_config(self, name, **overrides):
+        node_dir = os.path.join(self.base_dir, name)
+        os.makedirs(node_dir, exist_ok=True)
+        settings = dict(self.settings, name_node_host=repr('127.0.0.1'), name_node_port=str(self.name_node_port),
+                        name_node_url=repr(self.name_node_url), data_node_host=repr('127.0.0.1'),
+                        metadata_dir=repr(os.path.join(self.base_dir, 'metadata')),
+                        data_blocks_dir=repr(os.path.join(self.base_dir, 'blocks')), **overrides)
+        with open(os.path.join(node_dir, 'config_param.py'), 'w', encoding='utf-8') as config_file:
+            config_file.writelines(f'{name} = {value}\n' for name, value in settings.items())
+        return node_dir
+
+    def spawn(self, name, args, **overrides):
+        # Run with -m from the process's directory, so its config_param.py shadows the repo's
+        node_dir = self.write_config(name, **overrides)
+        log = open(os.path.join(node_dir, 'log'), 'ab')
+        env = dict(os.environ, PYTHONPATH=REPO_DIR, PYTHONUNBUFFERED='1')
+        try:
+            return subprocess.Popen([sys.executable, '-m', *args], cwd=node_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        finally:
+            log.close()
+
+    def start(self):
+        self.name_node_port = free_port()
+        self.name_node_url = f'http://127.0.0.1:{self.name_node_port}'
+        self.name_node = self.spawn('namenode', ['namenode'])
+        wait_for(lambda: self.live_data_nodes() is not None, 30, 'the Name Node to start')
+        for index in range(len(self.data_nodes)):
+            self.start_data_node(index)
+        wait_for(lambda: self.live_data_nodes() == len(self.data_nodes), 30, 'the Data Nodes to register')
+
+    def start_data_node(self, index):
+        # The same port and directory each time, so a restarted Data Node gets its ID and blocks back
+        self.data_nodes[index] = self.spawn(f'datanode{index}', ['datanode'], data_node_port=str(self.data_node_ports[index]))
+
+    def kill_data_node(self, index):
+        # SIGKILL, so the Data Node gets no chance to finish transfers or send notices
+        self.data_nodes[index].kill()
+        self.data_nodes[index].wait()
+
+    def live_data_nodes(self):
+        try:
+            return len(requests.get(f'{self.name_node_url}/metadata', timeout=5).json()['data_nodes'])
+        except requests.RequestException:
+            return None
+
+    def replication_status(self):
+        return requests.get(f'{self.name_node_url}/replication_status', timeout=5).json()
+
+    def start_workload(self, name, options):
+        node_dir = self.write_config(f'client-{name}')
+        result_path = os.path.join(node_dir, 'result.json')
+        if os.path.exists(result_path):
+            os.remove(result_path)
+        proc = self.spawn(f'client-{name}', ['benchmark', '--worker', name, '--result', result_path,
+                                             '--options', json.dumps(options)])
+        return proc, result_path
+
+    def finish_workload(self, proc, result_path):
+        proc.wait()
+        if proc.returncode != 0 or not os.path.exists(result_path):
+            raise RuntimeError(f'Workload failed with exit code {proc.returncode}, see {os.path.dirname(result_path)}/log')
+        with open(result_path, encoding='utf-8') as result_file:
+            return json.load(result_file)
+
+    def run_workload(self, name, options):
+        return self.finish_workload(*self.start_workload(name, options))
+
+    def stop(self, keep=False):
+        for proc in [self.name_node] + self.data_nodes:
+            if proc and proc.poll() is None:
+                proc.terminate()
+        for proc in [self.name_node] + self.data_nodes:
+            if proc:
+                proc.wait()
+        if not keep:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+
+def wait_for(predicate, timeout, what):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise RuntimeError(f'Timed out waiting for {what}')
+        time.sleep(0.2)
+
+
+def summarize(samples, num_bytes=None):
+    # Latencies in milliseconds, p50/p99 by nearest rank
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    summary = {'count': len(samples),
+               'p50_ms': samples[int(0.50 * (len(samples) - 1))] * 1000,
+               'p99_ms': samples[int(0.99 * (len(samples) - 1))] * 1000,
+               'max_ms': samples[-1] * 1000,
+               'mean_ms': sum(samples) / len(samples) * 1000}
+    if num_bytes is not None:
+        summary['mb_per_s'] = num_bytes / 1e6 / summary['p50_ms'] * 1000
+    return summary
+
+
+def timed(operation, *args, **kwargs):
+    start = time.perf_counter()
+    result = operation(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def write_random_file(path, size):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as file:
+        while size > 0:
+            file.write(os.urandom(min(size, 1024 * 1024)))
+            size -= 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Workloads run in a client process against the cluster named by its config_param.py, and return a
+# JSON-serializable result
+
+def sequential_workload(client, options):
+    # Large file upload then download, repeated; each download is checked against the original
+    path = 'bench_sequential.bin'
+    write_random_file(path, options['file_size'])
+    digest = file_digest(path)
+    uploads, downloads, failures, verified = [], [], 0, True
+    for _ in range(options['repeat']):
+        # Every repeat sends the same content, which deduplication would otherwise skip
+        uploaded, elapsed = timed(client.send_file_to_datanode, path, dedup=False)
+        if not uploaded:
+            failures += 1
+            continue
+        uploads.append(elapsed)
+        downloaded, elapsed = timed(client.request_file_download, path)
+        if not downloaded:
+            failures += 1
+            continue
+        downloads.append(elapsed)
+        verified = verified and file_digest('new_' + path) == digest
+    return {'file_bytes': options['file_size'], 'failures': failures, 'verified': verified,
+            'upload': summarize(uploads, options['file_size']),
+            'download': summarize(downloads, options['file_size'])}
+
+
+def small_files_workload(client, options):
+    # Many small files uploaded one at a time and packed into containers, then read back
+    contents = [os.urandom(options['small_file_size']) for _ in range(options['small_files'])]
+    paths = {}
+    for mode in ('individual', 'packed'):
+        paths[mode] = [os.path.join('bench_small', mode, f'f{index}') for index in range(len(contents))]
+        for path, data in zip(paths[mode], contents):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(data)
+
+    with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+        start = time.perf_counter()
+        uploads = list(executor.map(lambda path: timed(client.send_file_to_datanode, path), paths['individual']))
+        individual_elapsed = time.perf_counter() - start
+
+    packed, packed_elapsed = timed(client.send_files_packed, paths['packed'])
+
+    def read(index):
+        downloaded, elapsed = timed(client.request_file_download, paths['packed'][index])
+        with open('new_' + os.path.basename(paths['packed'][index]), 'rb') as file:
+            return downloaded and file.read() == contents[index], elapsed
+
+    with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+        start = time.perf_counter()
+        reads = list(executor.map(read, range(len(contents))))
+        read_elapsed = time.perf_counter() - start
+
+    return {'files': len(contents), 'file_bytes': options['small_file_size'],
+            'individual_upload': dict(summarize([elapsed for _, elapsed in uploads]),
+                                      ops_per_s=len(contents) / individual_elapsed,
+                                      failures=sum(not uploaded for uploaded, _ in uploads)),
+            'packed_upload': {'seconds': packed_elapsed, 'ops_per_s': len(contents) / packed_elapsed, 'success': packed},
+            'packed_read': dict(summarize([elapsed for _, elapsed in reads]), ops_per_s=len(contents) / read_elapsed,
+                                failures=sum(not verified for verified, _ in reads))}
+
+
+def metadata_workload(client, options):
+    # Concurrent /create_file calls mixed with /list_files pages. Afterwards the listing must hold
+    # exactly the files whose creation was acknowledged
+    latencies = {'create_file': [], 'list_files': []}
+    created = []
+    failures = {'create_file': 0, 'list_files': 0}
+    lock = threading.Lock()
+
+    def storm(thread):
+        for index in range(options['metadata_ops'] // options['threads']):
+            if index % options['list_every'] == options['list_every'] - 1:
+                op = 'list_files'
+                response, elapsed = timed(client.rpc.get, f'{client.name_node_url}/list_files',
+                                          params={'path': '/bench_meta', 'limit': 100})
+            else:
+                op = 'create_file'
+                path = f'/bench_meta/t{thread}/f{index}'
+                response, elapsed = timed(client.rpc.post, f'{client.name_node_url}/create_file', {'file_path': path})
+            with lock:
+                latencies[op].append(elapsed)
+                if response.status_code != 200:
+                    failures[op] += 1
+                elif op == 'create_file':
+                    created.append(path)
+
+    with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+        start = time.perf_counter()
+        # list() re-raises any thread's error rather than reporting a partial storm
+        list(executor.map(storm, range(options['threads'])))
+        elapsed = time.perf_counter() - start
+
+    directories = {f'/bench_meta/t{thread}' for thread in range(options['threads'])}
+    listed = set(client.iter_files('/bench_meta')) - directories
+    return {'threads': options['threads'], 'ops_per_s': sum(map(len, latencies.values())) / elapsed,
+            'consistent': listed == set(created),
+            **{op: dict(summarize(samples), failures=failures[op]) for op, samples in latencies.items()}}
+
+
+WORKLOADS = {'sequential': sequential_workload, 'small_files': small_files_workload, 'metadata': metadata_workload}
+
+
+def kill_during_write(cluster, options):
+    # A large upload with the last Data Node killed part-way, then the time until the Name Node has
+    # declared it dead and restored every block's replication
+    proc, result_path = cluster.start_workload('sequential', dict(options, repeat=1))
+    time.sleep(options['kill_after'])
+    index = len(cluster.data_nodes) - 1
+    cluster.kill_data_node(index)
+    killed = time.time()
+    result = cluster.finish_workload(proc, result_path)
+
+    def recovered():
+        status = cluster.replication_status()
+        return (cluster.live_data_nodes() == len(cluster.data_nodes) - 1
+                and status['under_replicated'] == 0 and status['pending_replications'] == 0)
+    try:
+        wait_for(recovered, options['recovery_timeout'], 're-replication')
+        result['recovery_s'] = time.time() - killed
+    except RuntimeError:
+        result['recovery_s'] = None
+    result['replication'] = cluster.replication_status()
+
+    cluster.start_data_node(index)
+    wait_for(lambda: cluster.live_data_nodes() == len(cluster.data_nodes), 60, 'the Data Node to rejoin')
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    settings = dict(setting.split('=', 1) for setting in args.set)
+    options = {'file_size': args.file_size * 1024 * 1024, 'repeat': args.repeat, 'small_files': args.small_files,
+               'small_file_size': args.small_file_size, 'metadata_ops': args.metadata_ops, 'threads': args.threads,
+               'list_every': args.list_every, 'kill_after': args.kill_after, 'recovery_timeout': args.recovery_timeout}
+    report = {'commit': git_commit(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'data_nodes': args.data_nodes,
+              'settings': settings, 'options': options, 'workloads': {}}
+
+    cluster = LocalCluster(args.data_nodes, settings)
+    try:
+        cluster.start()
+        for name in args.workloads.split(','):
+            print(f"Running {name}", file=sys.stderr)
+            if name == 'kill_during_write':
+                report['workloads'][name] = kill_during_write(cluster, options)
+            else:
+                report['workloads'][name] = cluster.run_workload(name, options)
+    finally:
+        cluster.stop(keep=args.keep)
+        if args.keep:
+            print(f"Cluster directories kept in {cluster.base_dir}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+
+def run_worker(args):
+    # Imported here: client reads config_param at import, which only the cluster's client directories provide
+    import client
+    result = WORKLOADS[args.worker](client, json.loads(args.options))
+    with open(args.result, 'w', encoding='utf-8') as result_file:
+        json.dump(result, result_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark YADFS on a local cluster of processes')
+    parser.add_argument('--data-nodes', type=int, default=4, help='more than replication_factor, so a killed node can be re-replicated')
+    parser.add_argument('--workloads', default='sequential,small_files,metadata,kill_during_write')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='config_param override as Python source, e.g. --set block_size=8*1024*1024')
+    parser.add_argument('--file-size', type=int, default=256, help='MiB per sequential file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--small-files', type=int, default=1000)
+    parser.add_argument('--small-file-size', type=int, default=4096)
+    parser.add_argument('--metadata-ops', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--list-every', type=int, default=10, help='every Nth metadata op is a /list_files page')
+    parser.add_argument('--kill-after', type=float, default=1.0, help='seconds after the write workload starts to kill a Data Node')
+    parser.add_argument('--recovery-timeout', type=float, default=300)
+    parser.add_argument('--output', help='also write the JSON report here')
+    parser.add_argument('--keep', action='store_true', help='keep the cluster directories and logs')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+    else:
+        run_benchmarks(args)
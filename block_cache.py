@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    # Byte-budgeted LRU cache of verified block pages, keyed by (block_id, page index)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.pages = OrderedDict()
+        self.block_pages = {}
+        # Bumped on every invalidation, so a page read from disk before a rewrite or delete
+        # can't be cached after it
+        self.generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+
+    def get(self, block_id, page):
+        with self.lock:
+            data = self.pages.get((block_id, page))
+            if data is None:
+                self.stats['misses'] += 1
+                return None, self.generation
+            self.pages.move_to_end((block_id, page))
+            self.stats['hits'] += 1
+            return data, self.generation
+
+    def put(self, block_id, page, data, generation):
+        if len(data) > self.capacity:
+            return
+        with self.lock:
+            if generation != self.generation or (block_id, page) in self.pages:
+                return
+            self.pages[(block_id, page)] = data
+            self.block_pages.setdefault(block_id, set()).add(page)
+            self.size += len(data)
+            while self.size > self.capacity:
+                (evicted_id, evicted_page), evicted = self.pages.popitem(last=False)
+                self._forget(evicted_id, evicted_page, evicted)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, block_id):
+        with self.lock:
+            self.generation += 1
+            for page in self.block_pages.get(block_id, set()).copy():
+                self._forget(block_id, page, self.pages.pop((block_id, page)))
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, size=self.size, capacity=self.capacity, pages=len(self.pages),
+                        hit_rate=self.stats['hits'] / lookups if lookups else 0.0)
+
+    def _forget(self, block_id, page, data):
+        self.size -= len(data)
+        pages = self.block_pages[block_id]
+        pages.discard(page)
+        if not pages:
+            del self.block_pages[block_id]
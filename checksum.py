@@ -0,0 +1,137 @@
+import os
+import struct
+import zlib
+import logging
+
+try:
+    # Hardware-accelerated CRC32C where the crc32c package is installed
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
+# The algorithm is recorded in each .meta header, so blocks stay verifiable if the package comes or goes
+ALGORITHMS = {b'CRCC': crc32c, b'CRC2': zlib.crc32}
+HEADER = struct.Struct('>4sI')
+log = logging.getLogger('checksum')
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def meta_path(path):
+    return path + '.meta'
+
+
+class BlockChecksum:
+    # Checksums a block in fixed-size chunks as it streams past, whatever sizes the writes arrive in
+    def __init__(self, chunk_size):
+        self.algorithm = b'CRCC' if crc32c else b'CRC2'
+        self.checksum = ALGORITHMS[self.algorithm]
+        self.chunk_size = chunk_size
+        self.checksums = []
+        self.partial = b''
+
+    def update(self, data):
+        view = memoryview(data)
+        if self.partial:
+            needed = self.chunk_size - len(self.partial)
+            self.partial += bytes(view[:needed])
+            view = view[needed:]
+            if len(self.partial) < self.chunk_size:
+                return
+            self.checksums.append(self.checksum(self.partial))
+            self.partial = b''
+        full = len(view) - len(view) % self.chunk_size
+        for offset in range(0, full, self.chunk_size):
+            self.checksums.append(self.checksum(view[offset:offset + self.chunk_size]))
+        self.partial = bytes(view[full:])
+
+    def write(self, path):
+        if self.partial:
+            self.checksums.append(self.checksum(self.partial))
+            self.partial = b''
+        with open(path, 'wb') as meta_file:
+            meta_file.write(HEADER.pack(self.algorithm, self.chunk_size))
+            meta_file.write(struct.pack(f'>{len(self.checksums)}I', *self.checksums))
+
+
+def read_checksums(path):
+    # Returns (checksum function, chunk size, checksums), or None for a block written without a .meta file
+    try:
+        with open(meta_path(path), 'rb') as meta_file:
+            data = meta_file.read()
+    except FileNotFoundError:
+        return None
+    return parse_checksums(data, path)
+
+
+def parse_checksums(data, path):
+    algorithm, chunk_size = HEADER.unpack_from(data)
+    checksum = ALGORITHMS.get(algorithm)
+    if checksum is None:
+        log.warning("Cannot verify %s: checksum %s not available", path, algorithm)
+        return None
+    count = (len(data) - HEADER.size) // 4
+    return checksum, chunk_size, struct.unpack_from(f'>{count}I', data, HEADER.size)
+
+
+def read_verified(path, start=0, stop=None, read_size=1024 * 1024):
+    # Yields bytes [start, stop) of the block, verifying every chunk they overlap before it is yielded
+    checksums = read_checksums(path)
+    with open(path, 'rb') as block_file:
+        size = os.fstat(block_file.fileno()).st_size
+        stop = size if stop is None else min(stop, size)
+        if checksums is None:
+            block_file.seek(start)
+            position = start
+            while position < stop:
+                data = block_file.read(min(read_size, stop - position))
+                if not data:
+                    return
+                position += len(data)
+                yield data
+            return
+
+        checksum, chunk_size, expected = checksums
+        if len(expected) != -(-size // chunk_size):
+            raise ChecksumError(f"{path} is {size} bytes but has {len(expected)} checksums")
+        # Reads start and end on chunk boundaries so every chunk can be checked whole
+        read_size = max(chunk_size, read_size - read_size % chunk_size)
+        position = start - start % chunk_size
+        end = min(size, -(-stop // chunk_size) * chunk_size)
+        block_file.seek(position)
+        while position < stop:
+            data = block_file.read(min(read_size, end - position))
+            if not data:
+                raise ChecksumError(f"{path} was truncated while being read")
+            view = memoryview(data)
+            for offset in range(0, len(data), chunk_size):
+                index = (position + offset) // chunk_size
+                if checksum(view[offset:offset + chunk_size]) != expected[index]:
+                    raise ChecksumError(f"Checksum mismatch in {path} at offset {index * chunk_size}")
+            yield data[max(start - position, 0):stop - position]
+            position += len(data)
+
+
+def verified_views(view, checksums, start, stop, read_size=1024 * 1024, path='block'):
+    # Like read_verified for a block already in memory, e.g. mmapped: yields views of [start, stop)
+    size = len(view)
+    stop = min(stop, size)
+    if checksums is None:
+        for position in range(start, stop, read_size):
+            yield view[position:min(position + read_size, stop)]
+        return
+
+    checksum, chunk_size, expected = checksums
+    if len(expected) != -(-size // chunk_size):
+        raise ChecksumError(f"{path} is {size} bytes but has {len(expected)} checksums")
+    read_size = max(chunk_size, read_size - read_size % chunk_size)
+    position = start - start % chunk_size
+    while position < stop:
+        end = min(position + read_size, size)
+        for offset in range(position, end, chunk_size):
+            if checksum(view[offset:min(offset + chunk_size, size)]) != expected[offset // chunk_size]:
+                raise ChecksumError(f"Checksum mismatch in {path} at offset {offset}")
+        yield view[max(start, position):min(stop, end)]
+        position = end
@@ -1,308 +1,763 @@
-import requests
-import json
-from collections import defaultdict
-import time
-import threading
-import os
-import config_param as cp
-
-name_node_url = cp.name_node_url  
-
-current_node_index = 0  # To keep track of the current data node to upload a block
-data_nodes = []
-
-
-def connect_to_namenode():
-    # Send connection request to Namenode and retrieve available Datanodes
-    response = requests.get(f'{name_node_url}/metadata')
-    print("Response from metadata: ", response)
-    if response.status_code == 200:
-        data_nodes = response.json().get('data_nodes')
-        print("Pinging Namenode")
-        return data_nodes
-    else:
-        print("Failed to connect to Namenode")
-        return None
-
-
-def split_file_into_blocks(file_path, block_size=10):
-    block_list = []
-    with open(file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-        num_lines = len(lines)
-        num_blocks = num_lines // block_size + (num_lines % block_size > 0)
-        for i in range(num_blocks):
-            start_idx = i * block_size
-            end_idx = min((i + 1) * block_size, num_lines)
-            block_list.append(''.join(lines[start_idx:end_idx]))
-        print(f"File '{file_path}' split into {num_blocks} blocks")
-    return block_list
-
-
-def retrieve_free_datanode(data_nodes):
-    # Retrieve a free Datanode endpoint from the Namenode
-    for data_node in data_nodes:
-        data_node_url = f'http://{data_node["host"]}:{data_node["port"]}/status'
-        response = requests.get(data_node_url)
-        if response.status_code == 200 and response.json().get('status') == 'active':
-            print(f"Retrieved free Datanode: {data_node_url}")
-            return data_node_url
-    return None
-
-
-def upload_block(data_node_url, block_id, block_data):
-    try:
-        data = {'operation': 'write', 'file_path': file_path, 'data_node_id': 1, 'block_id': block_id,
-                'data_block_content': block_data}
-        print("Uploading to data_node_url: ", data_node_url)
-        response = requests.post(f'{data_node_url}/handle_client_request', json=data)
-        if response.status_code == 200:
-            print(f"Block {block_id} uploaded to {data_node_url}")
-            return True
-        else:
-            print(f"Failed to upload Block {block_id} to {data_node_url}. Status Code: {response.status_code}")
-            return False
-    except requests.RequestException as e:
-        print(f"Error uploading Block {block_id} to {data_node_url}: {e}")
-        return False
-
-
-def send_file_to_datanode(file_path, data_nodes):
-    global current_node_index
-    blocks = split_file_into_blocks(file_path)
-    num_nodes = len(data_nodes)
-    file_name = os.path.basename(file_path)
-
-    for idx, block in enumerate(blocks):
-        block_id = f"{file_name}_block_{idx + 1}"
-        current_node = data_nodes[current_node_index]
-        data_node_url = f'http://{current_node["host"]}:{current_node["port"]}'
-        
-        print(f"Uploading block {block_id} to Datanode: {data_node_url}")
-        success = upload_block(data_node_url, block_id, block)
-        
-        if success:
-            print(f"Finished uploading block {block_id} to Datanode: {data_node_url}")
-            current_node_index = (current_node_index + 1) % num_nodes  # Move to the next data node
-    
-    return True
-
-
-def write_to_local_file(file_name, data_blocks):
-    print(file_name, data_blocks)
-    with open("new_"+file_name, 'wb') as file:
-        for i, value in enumerate(data_blocks.values()):
-            file.write(value.encode())
-
-# Download protocols
-def request_file_download(file_name):
-    # Request the Namenode for Datanode URLs where the file is present
-    data = {"file_path": file_name}
-    response = requests.get(f'{name_node_url}/get_file_metadata', json=data)
-    #print("***response:", response.json())
-
-    if response.status_code == 200:
-        data_node_details = response.json().get('metadata', [])
-        blocks = data_node_details.get('blocks')
-
-        data_blocks = {}
-        for idx, block in enumerate(blocks):
-            block_id = block.get('block_id')
-            current_node = data_nodes[current_node_index]
-            data_node_url = f'http://{current_node["host"]}:{current_node["port"]}'
-
-            block_data = download_block(data_node_url, block_id)
-            if block_data:
-                data_blocks[block_id] = block_data
-
-        #print("All data blocks:", data_blocks)
-        write_to_local_file(os.path.basename(file_name), data_blocks)
-        return data_blocks
-    else:
-        print(f"Failed to get Datanode URLs for file '{file_name}'")
-        return []
-
-
-def download_block(data_node_url, block_id):
-    try:
-        data = {'operation': 'read', 'file_path': file_path, 'data_node_id': 1, 'block_id': block_id}
-        #print("Reading from data_node_url: ", data_node_url)
-        response = requests.post(f'{data_node_url}/handle_client_request', json=data)
-        if response.status_code == 200:
-            data_block = response.content
-            data_block = data_block.decode()
-            data_block = json.loads(data_block)
-            # Decode the bytes as a string
-            data_block = data_block["data_block"]
-            #print(f"Block {block_id} read from {data_node_url}")
-            #print(data_block)
-            return data_block
-        else:
-            print(f"Failed to read block {block_id} from {data_node_url}. Status Code: {response.status_code}")
-            return ""
-    except requests.RequestException as e:
-        print(f"Error reading Block {block_id} to {data_node_url}: {e}")
-        return ""
-
-
-
-def verify_blocks(blocks):
-    # Verify if all blocks are received
-    expected_block_ids = set(f"block_{i}" for i in range(1, len(blocks) + 1))
-    received_block_ids = set(blocks.keys())
-    return expected_block_ids == received_block_ids
-
-
-def send_acknowledgement(successful):
-    # Send acknowledgement to the server
-    if successful:
-        print("File download successful. Sending acknowledgement...")
-    else:
-        print("File download unsuccessful")
-
-
-def download_file(file_name):
-    data_blocks = request_file_download(file_name)
-    status = True
-    # if data_blocks:
-    #     sorted_blocks = rearrange_blocks(file_name, data_blocks)
-    #     if verify_blocks(data_blocks):
-    #         print("All blocks received and arranged successfully")
-    #         status = True
-    #     else:
-    #         status = False
-    send_acknowledgement(status)
-
-
-import copy
-def client_operations():
-        while True:
-            data_nodes_copy = copy.deepcopy(data_nodes)
-
-            print("data_nodes: ", data_nodes_copy)
-            if data_nodes_copy:
-                nodes_to_remove = []
-                
-                for node in data_nodes_copy:
-                    data_node_url = f'http://{node["host"]}:{node["port"]}'
-                    print(f"Uploading to Datanode: {data_node_url}")
-                    success = send_file_to_datanode(file_path, data_node_url)
-
-                    if success:
-                        nodes_to_remove.append(node)
-                    else:
-                        print("Aborting further uploads due to failure")
-                        break
-            # print(f"Downloading file: {file_name}")
-                for node in nodes_to_remove:
-                    data_nodes_copy.remove(node)
-                    print(f"Removed node from data_node_copy: {node}")
-            # Add a delay before the next iteration
-            time.sleep(5) 
-
-
-def list_all_files():
-    response = requests.get(f'{name_node_url}/list_files')
-    if response.status_code == 200:
-        files = response.json()
-        print(files)
-    else:
-        print(f"Failed to get files. Status Code: {response.status_code}")
-
-def create_file(file_path):
-    response = requests.post(f'{name_node_url}/create_file', json={'file_path': file_path})
-    if response.status_code == 200:
-        print(f"File '{file_path}' created successfully.")
-    else:
-        print(f"Failed to create a new file. Status Code: {response.status_code}")
-
-def delete_file(file_path):
-    response = requests.post(f'{name_node_url}/delete_file', json={'file_path': file_path})
-    if response.status_code == 200:
-        print(f"File '{file_path}' deleted successfully.")
-    else:
-        print(f"Failed to delete file. Status Code: {response.status_code}")
-
-def move_file(src_path, dest_path):
-    response = requests.post(f'{name_node_url}/move_file', json={'src_path': src_path, 'dest_path': dest_path})
-    if response.status_code == 200:
-        print(f"File '{src_path}' moved to '{dest_path}' successfully.")
-    else:
-        print(f"Failed to move file. Status Code: {response.status_code}")
-
-def copy_file(src_path, dest_path):
-    response = requests.post(f'{name_node_url}/copy_file', json={'src_path': src_path, 'dest_path': dest_path})
-
-    if response.status_code == 200:
-        print(f"File '{src_path}' copied to '{dest_path}' successfully.")
-    else:
-        print(f"Failed to copy file. Status Code: {response.status_code}")
-
-def traverse_directory(directory_path):
-    response = requests.post(f'{name_node_url}/traverse_directory', json={'directory_path': directory_path})
-
-    if response.status_code == 200:
-        print("\nFiles and Directories in the specified directory:")
-        print(response.json())
-    else:
-        print(f"Failed to traverse directory. Status Code: {response.status_code}")
-
-
-    
-
-if __name__ == "__main__":
-    current_node_index = 0  # To keep track of the current data node to upload a block
-    data_nodes = connect_to_namenode()
-    
-    while True:
-        print("\nChoose a client action to perform:")
-        print("1. Upload a file")
-        print("2. Download a file")
-        print("3. List all files and directories")
-        print("4. Create a file")
-        print("5. Delete a file")
-        print("6. Move a file")
-        print("7. Copy a file")
-
-        print("0. Exit")
-
-        choice = input("Enter your choice: ")
-
-        if choice == '1':
-            file_path = input("Enter the path of the file to upload: ")
-            send_file_to_datanode(file_path,data_nodes)
-        elif choice == '2':
-            file_path = input("Enter the path of the file to download: ")
-            download_file(file_path)
-                          
-        elif choice == '3':
-            list_all_files()
-        elif choice == '4':
-            file_path = input("Enter the path of the file to create: ")
-            create_file(file_path)
-        elif choice == '5':
-            file_path = input("Enter the path of the file to delete: ")
-            delete_file(file_path)
-        elif choice == '6':
-            src_path = input("Enter the source path of the file: ")
-            dest_path = input("Enter the destination path of the file: ")
-            move_file(src_path, dest_path)
-        elif choice == '7':
-            src_path = input("Enter the source path of the file: ")
-            dest_path = input("Enter the destination path of the file: ")
-            copy_file(src_path, dest_path)
-        elif choice == '8':
-            directory_path = input("Enter the directory path to traverse: ")
-            traverse_directory(directory_path)
-        elif choice == '0':
-            print("Exiting the client program.")
-            break
-        else:
-            print("Invalid choice. Please enter a valid option.")
-
-    # Create a separate thread for the client operations
-    client_thread = threading.Thread(target=client_operations)
-    client_thread.start()
-
-    # Main thread can do other things or just wait for the client thread to finish
+import requests
+import json
+from collections import defaultdict
+import time
+import threading
+import os
+import socket
+import struct
+import hashlib
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+import config_param as cp
+import rpc
+import compression
+from checksum import parse_checksums, verified_views
+
+name_node_url = cp.name_node_url  
+
+data_nodes = []
+
+
+def connect_to_namenode():
+    # Send connection request to Namenode and retrieve available Datanodes
+    response = rpc.get(f'{name_node_url}/metadata')
+    print("Response from metadata: ", response)
+    if response.status_code == 200:
+        data_nodes = rpc.decode(response).get('data_nodes')
+        print("Pinging Namenode")
+        return data_nodes
+    else:
+        print("Failed to connect to Namenode")
+        return None
+
+
+def split_file_into_blocks(file_path, block_size=cp.block_size):
+    # Yield fixed-size byte blocks lazily so only one block is held in memory at a time
+    num_blocks = 0
+    with open(file_path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            num_blocks += 1
+            yield block
+    print(f"File '{file_path}' split into {num_blocks} blocks")
+
+
+def upload_block(data_node_url, file_path, block_id, block_data, targets):
+    try:
+        print("Uploading to data_node_url: ", data_node_url)
+        params = {'file_path': file_path, 'targets': ','.join(targets)}
+        # Not retried here: upload_block_with_retries moves a failed block to another pipeline
+        response = rpc.call('PUT', f'{data_node_url}/blocks/{block_id}', params=params, data=block_data,
+                            headers={'Content-Type': 'application/octet-stream'}, retries=0, timeout=cp.pipeline_timeout)
+        if response.status_code == 200:
+            replicas = rpc.decode(response).get('replicas', [])
+            print(f"Block {block_id} uploaded to {data_node_url} and replicated to {len(replicas)} Datanodes")
+            return replicas
+        else:
+            print(f"Failed to upload Block {block_id} to {data_node_url}. Status Code: {response.status_code}")
+            return None
+    except requests.RequestException as e:
+        print(f"Error uploading Block {block_id} to {data_node_url}: {e}")
+        return None
+
+
+def allocate_block(file_path, replication, exclude):
+    # Ask the Namenode for the ordered list of Datanodes that should hold the block
+    data = {'file_path': file_path, 'replication': replication, 'exclude': list(exclude)}
+    try:
+        response = rpc.post(f'{name_node_url}/allocate_block', data, retries=0)
+    except requests.RequestException as e:
+        print(f"Error allocating a block for '{file_path}': {e}")
+        return None
+    if response.status_code == 200:
+        return rpc.decode(response)
+    else:
+        print(f"Failed to allocate a block for '{file_path}'. Status Code: {response.status_code}")
+        return None
+
+
+def upload_block_with_retries(file_path, block_data, replication):
+    # Exclude the pipeline head after a failure so one slow or dead node doesn't stall the upload
+    failed_nodes = set()
+    for attempt in range(cp.upload_retries):
+        allocation = allocate_block(file_path, replication, failed_nodes)
+        if allocation:
+            block_id = allocation['block_id']
+            targets = allocation['targets']
+            head = targets[0]
+            data_node_url = f'http://{head["host"]}:{head["port"]}'
+            pipeline = [f'{node["host"]}:{node["port"]}' for node in targets[1:]]
+            replicas = upload_block(data_node_url, file_path, block_id, block_data, pipeline)
+            if replicas:
+                return {'block_id': block_id, 'data_node_id': head['id'], 'replicas': replicas, 'size': len(block_data)}
+            failed_nodes.add(head['id'])
+        time.sleep(rpc.backoff(attempt))
+    return None
+
+
+def lookup_fingerprint(fingerprint):
+    # The entry of a live block with this content, or None; a failed lookup just means uploading
+    try:
+        response = rpc.post(f'{name_node_url}/lookup_fingerprints', {'fingerprints': [fingerprint]})
+        if response.status_code == 200:
+            return rpc.decode(response)['blocks'].get(fingerprint)
+    except requests.RequestException as e:
+        print(f"Error looking up block fingerprint: {e}")
+    return None
+
+
+def upload_file_block(file_path, block_data, replication, dedup=cp.deduplication):
+    # Runs in the upload pool, so one block hashes and compresses while others are on the wire
+    fingerprint = hashlib.sha256(block_data).hexdigest()
+    if dedup:
+        existing = lookup_fingerprint(fingerprint)
+        if existing:
+            return dict(existing, deduplicated=True)
+    codec, stored_data = compression.compress_block(block_data)
+    uploaded = upload_block_with_retries(file_path, stored_data, replication)
+    if uploaded:
+        uploaded['fingerprint'] = fingerprint
+        if codec:
+            uploaded.update(size=len(block_data), codec=codec, stored_size=len(stored_data))
+    return uploaded
+
+
+def commit_file(file_path, blocks, replication):
+    # Returns (committed, IDs of reused blocks that were deleted since their lookup)
+    data = {'file_path': file_path, 'blocks': blocks, 'replication': replication}
+    # Committing the same block list twice leaves the same file, so this one is retried
+    response = rpc.post(f'{name_node_url}/commit_file', data)
+    if response.status_code == 200:
+        # Locations cached for the file's previous blocks are stale now
+        invalidate_file_metadata(file_path)
+        print(f"Committed {len(blocks)} blocks for '{file_path}'")
+        return True, []
+    stale_blocks = []
+    if response.status_code == 409:
+        reply = rpc.decode(response)
+        if reply.get('code') == 'stale_blocks':
+            stale_blocks = reply['stale_blocks']
+    print(f"Failed to commit '{file_path}'. Status Code: {response.status_code}")
+    return False, stale_blocks
+
+
+def upload_stale_blocks(file_path, uploaded_blocks, stale_blocks, replication):
+    # Uploads the data of the given reused blocks again, replacing their entries and keeping the rest
+    for idx, block in enumerate(split_file_into_blocks(file_path)):
+        if uploaded_blocks[idx]['block_id'] in stale_blocks:
+            uploaded = upload_file_block(file_path, block, replication, dedup=False)
+            if uploaded is None:
+                return False
+            uploaded_blocks[idx] = uploaded
+    return True
+
+
+def send_file_to_datanode(file_path, replication=cp.replication_factor, dedup=cp.deduplication):
+    # Bounds the number of blocks read ahead of the uploads, and so the client's memory use
+    blocks_in_flight = threading.BoundedSemaphore(cp.upload_concurrency)
+    futures = []
+    total_bytes = 0
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=cp.upload_concurrency) as executor:
+        for idx, block in enumerate(split_file_into_blocks(file_path)):
+            blocks_in_flight.acquire()
+            print(f"Uploading block {idx + 1} of '{file_path}'")
+            future = executor.submit(upload_file_block, file_path, block, replication, dedup)
+            future.add_done_callback(lambda f: blocks_in_flight.release())
+            futures.append(future)
+            total_bytes += len(block)
+
+        uploaded_blocks = [future.result() for future in futures]
+
+    elapsed = time.time() - start_time
+    if None in uploaded_blocks:
+        print(f"Failed to upload {uploaded_blocks.count(None)} of {len(uploaded_blocks)} blocks of '{file_path}'")
+        return False
+    print(f"Uploaded {total_bytes / 1e6:.1f} MB in {elapsed:.2f}s ({total_bytes / 1e6 / max(elapsed, 1e-6):.1f} MB/s)")
+    reused = [block for block in uploaded_blocks if block.get('deduplicated')]
+    if reused:
+        print(f"{len(reused)} of {len(uploaded_blocks)} blocks were already stored and not sent "
+              f"({sum(block['size'] for block in reused) / 1e6:.1f} MB)")
+
+    # Blocks finish out of order; the Namenode records them in file order in one commit
+    committed, stale_blocks = commit_file(file_path, uploaded_blocks, replication)
+    # A reused block may have been deleted with its last file since the lookup. Each round replaces
+    # reused blocks with uploaded ones, so this ends
+    while stale_blocks:
+        print(f"Uploading {len(stale_blocks)} blocks of '{file_path}' again, they were deleted since their lookup")
+        if not upload_stale_blocks(file_path, uploaded_blocks, set(stale_blocks), replication):
+            return False
+        committed, stale_blocks = commit_file(file_path, uploaded_blocks, replication)
+    return committed
+
+
+def pack_small_files(file_paths, container_size=cp.container_size):
+    # Yield (container bytes, [{file_path, offset, length}]), appending files until the next one won't fit
+    container = bytearray()
+    entries = []
+    for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        if entries and len(container) + len(data) > container_size:
+            yield bytes(container), entries
+            container = bytearray()
+            entries = []
+        entries.append({'file_path': file_path, 'offset': len(container), 'length': len(data)})
+        container += data
+    if entries:
+        yield bytes(container), entries
+
+
+def commit_packed(container, entries, replication):
+    data = {'container': container, 'files': entries, 'replication': replication}
+    # Like commit_file, committing the same container twice leaves the same files
+    response = rpc.post(f'{name_node_url}/commit_packed', data)
+    if response.status_code == 200:
+        for entry in entries:
+            invalidate_file_metadata(entry['file_path'])
+        print(f"Committed {len(entries)} files packed into {container['block_id']}")
+        return True
+    else:
+        print(f"Failed to commit {len(entries)} packed files. Status Code: {response.status_code}")
+        return False
+
+
+def send_files_packed(file_paths, replication=cp.replication_factor):
+    # Small files share container blocks, so thousands of them cost a few blocks and commits instead
+    # of one each; larger files are uploaded on their own
+    small_files = [path for path in file_paths if os.path.getsize(path) < cp.small_file_threshold]
+    large_files = [path for path in file_paths if os.path.getsize(path) >= cp.small_file_threshold]
+    success = all([send_file_to_datanode(path, replication) for path in large_files])
+    for container, entries in pack_small_files(small_files):
+        print(f"Uploading a container of {len(entries)} files ({len(container)} bytes)")
+        uploaded = upload_block_with_retries(entries[0]['file_path'], container, replication)
+        if uploaded is None:
+            print(f"Failed to upload a container of {len(entries)} files")
+            success = False
+        elif not commit_packed(uploaded, entries, replication):
+            success = False
+    return success
+
+
+def upload_directory(directory_path, replication=cp.replication_factor):
+    file_paths = [os.path.join(root, name) for root, _, names in os.walk(directory_path) for name in sorted(names)]
+    return send_files_packed(file_paths, replication)
+
+
+# Per data node download load and latency, used to pick a replica for each block
+replica_stats = defaultdict(lambda: {'in_flight': 0, 'latency': 0.0})
+replica_stats_lock = threading.Lock()
+local_hosts = {'127.0.0.1', 'localhost', socket.gethostname()}
+
+
+def rank_replicas(locations):
+    # Prefer replicas on this host, then the least loaded, then the fastest recently
+    with replica_stats_lock:
+        return sorted(locations, key=lambda node: (node['host'] not in local_hosts,
+                                                   replica_stats[node['id']]['in_flight'],
+                                                   replica_stats[node['id']]['latency']))
+
+
+def block_offsets(blocks):
+    offsets = []
+    offset = 0
+    for block in blocks:
+        offsets.append(offset)
+        if block.get('size') is None:
+            block['size'] = fetch_block_size(block)
+        offset += block['size']
+    return offsets, offset
+
+
+def fetch_block_size(block):
+    # Blocks committed before sizes were recorded: ask a replica for the length
+    for node in block_candidates(block):
+        try:
+            response = rpc.call('HEAD', f'http://{node["host"]}:{node["port"]}/blocks/{block["block_id"]}')
+            if response.status_code == 200:
+                return int(response.headers['Content-Length'])
+        except requests.RequestException as e:
+            print(f"Error reading size of Block {block['block_id']} from {node['host']}:{node['port']}: {e}")
+    raise IOError(f"No replica of block {block['block_id']} is reachable")
+
+
+def block_candidates(block):
+    return rank_replicas(block.get('locations', []))
+
+
+def download_block_with_failover(block, output_path, offset):
+    if block['size'] == 0:
+        return True
+    # A replica on this host is read straight from its disk; any failure falls back to HTTP
+    for node in block_candidates(block):
+        socket_path = short_circuit_socket(node)
+        if socket_path and read_local_block(socket_path, node, block, output_path, offset) == block['size']:
+            return True
+    for node in block_candidates(block):
+        data_node_url = f'http://{node["host"]}:{node["port"]}'
+        with replica_stats_lock:
+            replica_stats[node['id']]['in_flight'] += 1
+        start_time = time.time()
+        try:
+            num_bytes = download_block(data_node_url, block['block_id'], output_path, offset,
+                                       block.get('offset'), block['size'], block.get('codec'))
+        finally:
+            with replica_stats_lock:
+                stats = replica_stats[node['id']]
+                stats['in_flight'] -= 1
+                stats['latency'] = 0.8 * stats['latency'] + 0.2 * (time.time() - start_time)
+        if num_bytes == block['size']:
+            return True
+        print(f"Retrying block {block['block_id']} on another replica")
+    return False
+
+
+# Block locations by path: {'id', 'generation', 'num_blocks', 'blocks': {index: block}, 'expires'}
+metadata_cache = {}
+metadata_cache_lock = threading.Lock()
+
+
+def fetch_file_metadata(file_name, **params):
+    response = rpc.get(f'{name_node_url}/get_file_metadata', dict(params, file_path=file_name))
+    if response.status_code != 200:
+        print(f"Failed to get block locations for '{file_name}'. Status Code: {response.status_code}")
+        return None
+    return rpc.decode(response)
+
+
+def get_block_locations(file_name, start_block, num_blocks):
+    # Returns (cache entry, blocks) for a window of the file, from the cache while the Namenode's lease holds
+    window = None
+    with metadata_cache_lock:
+        entry = metadata_cache.get(file_name)
+        if entry:
+            window = [entry['blocks'].get(index) for index in range(start_block, min(start_block + num_blocks, entry['num_blocks']))]
+            if time.time() < entry['expires'] and None not in window:
+                return entry, window
+
+    params = {'start_block': start_block, 'num_blocks': num_blocks}
+    if window is not None and None not in window:
+        # Lease expired: sending the cached version lets the Namenode answer not_modified instead of the blocks
+        params.update(file_id=entry['id'], generation=entry['generation'])
+    reply = fetch_file_metadata(file_name, **params)
+    if reply is None:
+        invalidate_file_metadata(file_name)
+        return None, None
+
+    with metadata_cache_lock:
+        if reply['status'] == 'not_modified':
+            entry['expires'] = time.time() + reply['lease']
+            return entry, window
+        metadata = reply['metadata']
+        entry = metadata_cache.get(file_name)
+        if not entry or (entry['id'], entry['generation']) != (metadata['id'], metadata['generation']):
+            # Rewritten, or deleted and created again: drop every block cached for the old version
+            entry = metadata_cache[file_name] = {'id': metadata['id'], 'generation': metadata['generation'],
+                                                 'num_blocks': metadata['num_blocks'], 'blocks': {}}
+        entry['expires'] = time.time() + reply['lease']
+        for index, block in enumerate(metadata['blocks'], start_block):
+            entry['blocks'][index] = block
+    return entry, metadata['blocks']
+
+
+def invalidate_file_metadata(file_name):
+    with metadata_cache_lock:
+        metadata_cache.pop(file_name, None)
+
+
+# Download protocols
+def request_file_download(file_name):
+    entry, blocks = get_block_locations(file_name, 0, cp.metadata_prefetch_blocks)
+    if entry is None:
+        print(f"Failed to get Datanode URLs for file '{file_name}'")
+        return False
+
+    # Each block is streamed straight to its offset, so blocks can land in any order
+    output_path = "new_" + os.path.basename(file_name)
+    open(output_path, 'wb').close()
+
+    futures = []
+    file_size = 0
+    start_block = 0
+    changed = False
+    with ThreadPoolExecutor(max_workers=cp.download_concurrency) as executor, ThreadPoolExecutor(max_workers=1) as prefetcher:
+        while blocks:
+            start_block += len(blocks)
+            # Look up the next window's locations while this window downloads
+            next_window = None
+            if start_block < entry['num_blocks']:
+                next_window = prefetcher.submit(get_block_locations, file_name, start_block, cp.metadata_prefetch_blocks)
+
+            offsets, window_size = block_offsets(blocks)
+            futures += [executor.submit(download_block_with_failover, block, output_path, file_size + offset)
+                        for block, offset in zip(blocks, offsets)]
+            file_size += window_size
+
+            blocks = None
+            if next_window:
+                next_entry, blocks = next_window.result()
+                changed = next_entry is None or (next_entry['id'], next_entry['generation']) != (entry['id'], entry['generation'])
+                if changed:
+                    print(f"'{file_name}' changed during the download")
+                    blocks = None
+
+        results = [future.result() for future in futures]
+
+    with open(output_path, 'r+b') as file:
+        file.truncate(file_size)
+    if changed or not all(results):
+        # Cached locations may be stale; the next attempt asks the Namenode again
+        invalidate_file_metadata(file_name)
+        print(f"Failed to download {results.count(False)} of {len(results)} blocks of '{file_name}'")
+        return False
+    return True
+
+
+def download_block(data_node_url, block_id, output_path, offset, block_offset=None, length=None, codec=None):
+    # block_offset and length select a packed file's range of its container block. A compressed
+    # block is decompressed as it streams in; the return value counts decompressed bytes
+    headers = {}
+    if block_offset is not None:
+        headers['Range'] = f'bytes={block_offset}-{block_offset + length - 1}'
+    try:
+        #print("Reading from data_node_url: ", data_node_url)
+        # A failed read fails over to another replica rather than retrying this one
+        with rpc.get(f'{data_node_url}/blocks/{block_id}', stream=True, retries=0, headers=headers) as response:
+            if response.status_code != (206 if headers else 200):
+                print(f"Failed to read block {block_id} from {data_node_url}. Status Code: {response.status_code}")
+                return None
+            num_bytes = 0
+            decompressor = compression.StreamDecompressor(codec) if codec else None
+            with open(output_path, 'r+b') as file:
+                file.seek(offset)
+                for chunk in response.iter_content(cp.transfer_chunk_size):
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    file.write(chunk)
+                    num_bytes += len(chunk)
+            #print(f"Block {block_id} read from {data_node_url}")
+            return num_bytes
+    except (requests.RequestException, IOError) as e:
+        print(f"Error reading Block {block_id} to {data_node_url}: {e}")
+        return None
+
+
+
+def short_circuit_socket(node):
+    # The Data Node's Unix socket, if it runs on this host
+    if not cp.short_circuit_reads or not hasattr(socket, 'recv_fds') or node['host'] not in local_hosts:
+        return None
+    path = cp.short_circuit_socket.format(data_blocks_dir=cp.data_blocks_dir, port=node['port'])
+    return path if os.path.exists(path) else None
+
+
+def check_short_circuit_peer(sock, socket_path):
+    # Descriptors are only taken from a process running as the user that owns the socket's directory,
+    # which is the Data Node's, so a socket planted by anyone else is refused
+    owner = os.stat(os.path.dirname(socket_path)).st_uid
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, peer_uid, _ = struct.unpack('3i', credentials)
+    else:
+        peer_uid = os.stat(socket_path).st_uid
+    if peer_uid != owner:
+        raise IOError(f"{socket_path} is served by user {peer_uid}, not the Data Node's user {owner}")
+
+
+def open_local_block(socket_path, data_node_id, block_id):
+    # Returns the block's file descriptor and, if it has checksums, its .meta file's
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(cp.rpc_timeout)
+        sock.connect(socket_path)
+        check_short_circuit_peer(sock, socket_path)
+        sock.sendall(json.dumps({'block_id': block_id, 'data_node_id': data_node_id}).encode() + b'\n')
+        message, fds, _, _ = socket.recv_fds(sock, 4096, 2)
+    reply = json.loads(message)
+    if reply['status'] != 'success':
+        for fd in fds:
+            os.close(fd)
+        raise IOError(reply['message'])
+    return fds[0], (fds[1] if len(fds) > 1 else None)
+
+
+def read_local_block(socket_path, node, block, output_path, offset):
+    # Same contract as download_block: the block is mmapped, checked against its .meta checksums
+    # and written out, without passing through the Data Node
+    try:
+        block_fd, meta_fd = open_local_block(socket_path, node['id'], block['block_id'])
+        with os.fdopen(block_fd, 'rb') as block_file, \
+                mmap.mmap(block_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            checksums = None
+            if meta_fd is not None:
+                with os.fdopen(meta_fd, 'rb') as meta_file:
+                    checksums = parse_checksums(meta_file.read(), block['block_id'])
+            start = block.get('offset') or 0
+            stop = start + block['size'] if block.get('offset') is not None else len(mapped)
+            decompressor = compression.StreamDecompressor(block['codec']) if block.get('codec') else None
+            num_bytes = 0
+            with open(output_path, 'r+b') as file, memoryview(mapped) as view:
+                file.seek(offset)
+                for chunk in verified_views(view, checksums, start, stop, cp.transfer_chunk_size, block['block_id']):
+                    with chunk:
+                        data = decompressor.decompress(chunk) if decompressor else chunk
+                        file.write(data)
+                        num_bytes += len(data)
+                    del data
+        return num_bytes
+    except (OSError, ValueError) as e:
+        print(f"Short-circuit read of Block {block['block_id']} failed: {e}")
+        return None
+
+
+def fetch_block(block):
+    # Reads a whole block into memory from the first replica that serves all of it
+    for node in block_candidates(block):
+        try:
+            response = rpc.get(f'http://{node["host"]}:{node["port"]}/blocks/{block["block_id"]}', retries=0)
+            if response.status_code == 200 and len(response.content) == block['size']:
+                return response.content
+        except requests.RequestException as e:
+            print(f"Error reading Block {block['block_id']} from {node['host']}:{node['port']}: {e}")
+    return None
+
+
+def compact_containers(max_live_ratio=cp.compaction_threshold):
+    # Rewrites containers that are mostly deleted files: their live entries are copied into a new
+    # container and the Namenode repoints the files and deletes the old one
+    response = rpc.get(f'{name_node_url}/containers', {'max_live_ratio': max_live_ratio})
+    if response.status_code != 200:
+        print(f"Failed to list containers. Status Code: {response.status_code}")
+        return False
+    compacted = 0
+    for container in rpc.decode(response)['containers']:
+        compacted += compact_container(container)
+    print(f"Compacted {compacted} containers")
+    return True
+
+
+def compact_container(container):
+    data = fetch_block(container)
+    if data is None:
+        print(f"Skipping container {container['block_id']}: no replica is readable")
+        return False
+
+    # Copies of a file share their range, so each range is copied once
+    packed = bytearray()
+    new_offsets = {}
+    entries = []
+    for entry in sorted(container['entries'], key=lambda entry: entry['offset']):
+        key = (entry['offset'], entry['length'])
+        if key not in new_offsets:
+            new_offsets[key] = len(packed)
+            packed += data[entry['offset']:entry['offset'] + entry['length']]
+        entries.append(dict(entry, new_offset=new_offsets[key]))
+
+    uploaded = upload_block_with_retries(container['block_id'], bytes(packed), container['replication'])
+    if uploaded is None:
+        print(f"Failed to upload the compacted copy of container {container['block_id']}")
+        return False
+    response = rpc.post(f'{name_node_url}/repack', {'old_block_id': container['block_id'],
+                                                    'container': uploaded, 'entries': entries})
+    if response.status_code != 200:
+        print(f"Failed to repack container {container['block_id']}. Status Code: {response.status_code}")
+        return False
+    print(f"Container {container['block_id']}: {container['size']} bytes compacted to {len(packed)}")
+    return True
+
+
+def verify_blocks(blocks):
+    # Verify if all blocks are received
+    expected_block_ids = set(f"block_{i}" for i in range(1, len(blocks) + 1))
+    received_block_ids = set(blocks.keys())
+    return expected_block_ids == received_block_ids
+
+
+def send_acknowledgement(successful):
+    # Send acknowledgement to the server
+    if successful:
+        print("File download successful. Sending acknowledgement...")
+    else:
+        print("File download unsuccessful")
+
+
+def download_file(file_name):
+    status = request_file_download(file_name)
+    # if data_blocks:
+    #     sorted_blocks = rearrange_blocks(file_name, data_blocks)
+    #     if verify_blocks(data_blocks):
+    #         print("All blocks received and arranged successfully")
+    #         status = True
+    #     else:
+    #         status = False
+    send_acknowledgement(status)
+
+
+import copy
+def client_operations():
+        while True:
+            data_nodes_copy = copy.deepcopy(data_nodes)
+
+            print("data_nodes: ", data_nodes_copy)
+            if data_nodes_copy:
+                nodes_to_remove = []
+                
+                for node in data_nodes_copy:
+                    data_node_url = f'http://{node["host"]}:{node["port"]}'
+                    print(f"Uploading to Datanode: {data_node_url}")
+                    success = send_file_to_datanode(file_path)
+
+                    if success:
+                        nodes_to_remove.append(node)
+                    else:
+                        print("Aborting further uploads due to failure")
+                        break
+            # print(f"Downloading file: {file_name}")
+                for node in nodes_to_remove:
+                    data_nodes_copy.remove(node)
+                    print(f"Removed node from data_node_copy: {node}")
+            # Add a delay before the next iteration
+            time.sleep(5) 
+
+
+def iter_files(directory_path='/', pattern=None, page_size=cp.list_page_size):
+    # Fetch the listing a page at a time, only when the caller gets to it
+    params = {'path': directory_path, 'limit': page_size}
+    if pattern:
+        params['pattern'] = pattern
+    while True:
+        response = rpc.get(f'{name_node_url}/list_files', params=params)
+        if response.status_code != 200:
+            print(f"Failed to get files. Status Code: {response.status_code}")
+            return
+        page = rpc.decode(response)
+        yield from page['files']
+        if not page.get('next_cursor'):
+            return
+        params['start_after'] = page['next_cursor']
+
+def list_all_files():
+    num_files = 0
+    for file_path in iter_files():
+        print(file_path)
+        num_files += 1
+    print(f"{num_files} files")
+
+def create_file(file_path):
+    response = rpc.post(f'{name_node_url}/create_file', {'file_path': file_path}, retries=0)
+    if response.status_code == 200:
+        print(f"File '{file_path}' created successfully.")
+    else:
+        print(f"Failed to create a new file. Status Code: {response.status_code}")
+
+def create_directory(directory_path):
+    response = rpc.post(f'{name_node_url}/create_directory', {'directory_path': directory_path}, retries=0)
+    if response.status_code == 200:
+        print(f"Directory '{directory_path}' created successfully.")
+    else:
+        print(f"Failed to create directory. Status Code: {response.status_code}")
+
+def delete_file(file_path):
+    response = rpc.post(f'{name_node_url}/delete_file', {'file_path': file_path}, retries=0)
+    if response.status_code == 200:
+        print(f"File '{file_path}' deleted successfully.")
+    else:
+        print(f"Failed to delete file. Status Code: {response.status_code}")
+
+def move_file(src_path, dest_path):
+    response = rpc.post(f'{name_node_url}/move_file', {'src_path': src_path, 'dest_path': dest_path}, retries=0)
+    if response.status_code == 200:
+        print(f"File '{src_path}' moved to '{dest_path}' successfully.")
+    else:
+        print(f"Failed to move file. Status Code: {response.status_code}")
+
+def copy_file(src_path, dest_path):
+    response = rpc.post(f'{name_node_url}/copy_file', {'src_path': src_path, 'dest_path': dest_path}, retries=0)
+
+    if response.status_code == 200:
+        print(f"File '{src_path}' copied to '{dest_path}' successfully.")
+    else:
+        print(f"Failed to copy file. Status Code: {response.status_code}")
+
+def traverse_directory(directory_path):
+    response = rpc.post(f'{name_node_url}/traverse_directory', {'directory_path': directory_path})
+
+    if response.status_code == 200:
+        print("\nFiles and Directories in the specified directory:")
+        print(rpc.decode(response))
+    else:
+        print(f"Failed to traverse directory. Status Code: {response.status_code}")
+
+
+    
+
+if __name__ == "__main__":
+    data_nodes = connect_to_namenode()
+    
+    while True:
+        print("\nChoose a client action to perform:")
+        print("1. Upload a file")
+        print("2. Download a file")
+        print("3. List all files and directories")
+        print("4. Create a file")
+        print("5. Delete a file")
+        print("6. Move a file")
+        print("7. Copy a file")
+        print("8. Traverse a directory")
+        print("9. Create a directory")
+        print("10. Upload a directory of small files")
+        print("11. Compact containers")
+
+        print("0. Exit")
+
+        choice = input("Enter your choice: ")
+
+        if choice == '1':
+            file_path = input("Enter the path of the file to upload: ")
+            send_file_to_datanode(file_path)
+        elif choice == '2':
+            file_path = input("Enter the path of the file to download: ")
+            download_file(file_path)
+                          
+        elif choice == '3':
+            list_all_files()
+        elif choice == '4':
+            file_path = input("Enter the path of the file to create: ")
+            create_file(file_path)
+        elif choice == '5':
+            file_path = input("Enter the path of the file to delete: ")
+            delete_file(file_path)
+        elif choice == '6':
+            src_path = input("Enter the source path of the file: ")
+            dest_path = input("Enter the destination path of the file: ")
+            move_file(src_path, dest_path)
+        elif choice == '7':
+            src_path = input("Enter the source path of the file: ")
+            dest_path = input("Enter the destination path of the file: ")
+            copy_file(src_path, dest_path)
+        elif choice == '8':
+            directory_path = input("Enter the directory path to traverse: ")
+            traverse_directory(directory_path)
+        elif choice == '9':
+            directory_path = input("Enter the path of the directory to create: ")
+            create_directory(directory_path)
+        elif choice == '10':
+            directory_path = input("Enter the path of the directory to upload: ")
+            upload_directory(directory_path)
+        elif choice == '11':
+            compact_containers()
+        elif choice == '0':
+            print("Exiting the client program.")
+            break
+        else:
+            print("Invalid choice. Please enter a valid option.")
+
+    # Create a separate thread for the client operations
+    client_thread = threading.Thread(target=client_operations)
+    client_thread.start()
+
+    # Main thread can do other things or just wait for the client thread to finish
     client_thread.join()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import zlib
+import config_param as cp
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# name -> (compress function, decompressor factory); a decompressor takes the stream chunk by chunk.
+# zlib is always there, so blocks written with it stay readable without the optional packages
+CODECS = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompressobj)}
+if zstandard:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=cp.zstd_level).compress(data),
+                      lambda: zstandard.ZstdDecompressor().decompressobj())
+if lz4:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.LZ4FrameDecompressor)
+
+# Checked here rather than on the first upload, where the error would surface from inside the upload pool
+if cp.block_compression not in ('auto', 'off', 'zlib', 'zstd', 'lz4'):
+    raise ValueError(f"block_compression must be auto, off, zlib, zstd or lz4, not {cp.block_compression!r}")
+
+
+def sample_ratio(data):
+    # Compressed/original size of a few slices spread over the block, at zlib's fastest level
+    sample_size = cp.compression_sample_size
+    if len(data) <= 4 * sample_size:
+        sample = data
+    else:
+        step = len(data) // 4
+        sample = b''.join(data[offset:offset + sample_size] for offset in range(0, 4 * step, step))
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def choose_codec(data):
+    if cp.block_compression == 'off' or not data:
+        return None
+    if cp.block_compression != 'auto':
+        # A forced codec whose package isn't installed falls back to zlib, as "auto" does
+        return cp.block_compression if cp.block_compression in CODECS else 'zlib'
+    ratio = sample_ratio(data)
+    if ratio > 1 - cp.compression_min_savings:
+        return None
+    # Text and logs that shrink a lot are worth zstd's better ratio; for the rest lz4 is cheaper
+    preference = ('zstd', 'lz4', 'zlib') if ratio < 0.5 else ('lz4', 'zstd', 'zlib')
+    return next(codec for codec in preference if codec in CODECS)
+
+
+def compress_block(data):
+    # Returns (codec, bytes to store); codec is None when the block is stored raw
+    codec = choose_codec(data)
+    if codec is None:
+        return None, data
+    compressed = CODECS[codec][0](data)
+    if len(compressed) > (1 - cp.compression_min_savings) * len(data):
+        # The sample promised more than the whole block delivers
+        return None, data
+    return codec, compressed
+
+
+class StreamDecompressor:
+    # Decompresses a block chunk by chunk as it is downloaded; a corrupt stream raises IOError whatever the codec
+    def __init__(self, codec):
+        if codec not in CODECS:
+            raise IOError(f"Block compressed with {codec}, which is not installed")
+        self.codec = codec
+        self.decompressor = CODECS[codec][1]()
+
+    def decompress(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except Exception as e:
+            raise IOError(f"Corrupt {self.codec} stream: {e}") from e
@@ -1,15 +1,141 @@
-# Name node details
-name_node_host = " "
-name_node_port = 
-name_node_url = "http://" + name_node_host + ":" + str(name_node_port)
-
-# Data node details
-data_node_host = " "
-data_node_port = 
-
-# Define the directory for metadata
-metadata_dir = r' '
-metadata_file_name = "metadata.json"
-
-#define the directory for data blocks
-data_blocks_dir = r' '
+# Name node details
+name_node_host = " "
+name_node_port = 
+name_node_url = "http://" + name_node_host + ":" + str(name_node_port)
+
+# Data node details
+data_node_host = " "
+data_node_port = 
+# Failure domain label used to spread replicas across racks
+data_node_rack = "/default-rack"
+
+# Block server: "flask" (threaded dev server) or "aiohttp" (asyncio, for many concurrent transfers)
+data_node_server = "flask"
+
+# aiohttp server: threads doing disk I/O, pending connection backlog and seconds to drain in-flight
+# transfers on shutdown
+async_io_threads = 32
+async_backlog = 1024
+async_shutdown_timeout = 30
+
+# Define the directory for metadata
+metadata_dir = r' '
+metadata_file_name = "metadata.json"
+edit_log_file_name = "edits.log"
+
+# RPC between all components: seconds before a request times out, attempts for calls that are
+# safe to repeat, jittered backoff bounds in seconds, and keep-alive connections pooled per peer
+rpc_timeout = 30
+rpc_retries = 3
+rpc_base_backoff = 0.1
+rpc_max_backoff = 2
+rpc_pool_size = 32
+rpc_max_peers = 64
+
+# Seconds between namespace checkpoints
+checkpoint_interval = 60
+
+#define the directory for data blocks
+data_blocks_dir = r' '
+
+# Size of each file block in bytes
+block_size = 64 * 1024 * 1024
+
+# Default number of replicas of each block, can be set per file on upload
+replication_factor = 3
+
+# Files smaller than this are packed into shared container blocks of up to container_size bytes;
+# containers whose live entries fill less than compaction_threshold of them are rewritten
+small_file_threshold = 1024 * 1024
+container_size = 64 * 1024 * 1024
+compaction_threshold = 0.5
+
+# Seconds a client may serve a file's block locations from its cache before revalidating,
+# and blocks whose locations it fetches ahead of a sequential read
+metadata_lease = 30
+metadata_prefetch_blocks = 64
+
+# Default and largest number of entries in one /list_files page
+list_page_size = 1000
+max_list_page_size = 10000
+
+# Seconds between Data Node heartbeats, and without one before a Data Node is declared dead
+heartbeat_interval = 3
+heartbeat_timeout = 60
+
+# Block received/deleted notices are sent to the Name Node in batches of up to this many,
+# or after this many seconds, whichever comes first
+block_report_batch_size = 100
+block_report_batch_interval = 1
+
+# Seconds between full block reports. The Name Node deletes reported replicas that no file references
+# once they are older than orphan_block_grace seconds; younger ones may still be waiting for their commit
+block_report_interval = 21600
+orphan_block_grace = 3600
+
+# Re-replication: seconds between scheduler passes, concurrent copies per Data Node,
+# seconds before an unconfirmed copy is rescheduled and bytes/s of copy traffic per Data Node
+replication_interval = 3
+max_replication_streams = 2
+replication_timeout = 300
+replication_bandwidth = 50 * 1024 * 1024
+
+# Chunks buffered between a Data Node and the next replica in the write pipeline
+pipeline_queue_depth = 8
+
+# Seconds to wait on the next Data Node in the write pipeline
+pipeline_timeout = 60
+
+# Number of blocks the client uploads concurrently
+upload_concurrency = 4
+
+# Attempts per block before an upload is abandoned
+upload_retries = 3
+
+# Number of blocks the client downloads concurrently
+download_concurrency = 4
+
+# Bytes read per chunk when streaming block transfers
+transfer_chunk_size = 1024 * 1024
+
+# Block compression on upload: "auto" picks zstd, lz4 or raw per block from a sample of its data,
+# "off" stores blocks raw and a codec name (zlib, zstd or lz4) forces that codec, or zlib if its package
+# isn't installed. Blocks that would save less than compression_min_savings of their size are stored raw
+block_compression = "auto"
+compression_sample_size = 64 * 1024
+compression_min_savings = 0.1
+zstd_level = 3
+
+# Skip uploading blocks whose content (by SHA-256) the cluster already stores
+deduplication = True
+
+# Short-circuit reads: a client on the same host as a Data Node reads its blocks straight from disk
+# through file descriptors handed over the Data Node's Unix socket ({port} is the Data Node's port).
+# The socket sits in a directory of its own that the Data Node creates with short_circuit_dir_mode,
+# so only the Data Node's user and group can reach it or put another socket in its place
+short_circuit_reads = True
+short_circuit_socket = "{data_blocks_dir}/short_circuit/datanode_{port}.sock"
+short_circuit_dir_mode = 0o750
+short_circuit_socket_mode = 0o660
+
+# Bytes of verified block pages each Data Node keeps in memory for repeat reads, 0 to disable
+block_cache_size = 256 * 1024 * 1024
+
+# Bytes covered by each checksum in a block's .meta file
+checksum_chunk_size = 64 * 1024
+
+# Block scrubber: seconds between passes, seconds a block may go unverified and bytes/s it may read
+scrub_interval = 60
+scrub_period = 24 * 3600
+scrub_bandwidth = 10 * 1024 * 1024
+
+# Logging: minimum level, "json" for one structured object per line or "text", and whether to log
+# every HTTP request
+log_level = "INFO"
+log_format = "json"
+access_log = False
+
+# Sampling profiler served at /debug/profile when enabled: seconds between samples and longest run
+profiler_enabled = False
+profiler_interval = 0.01
+profiler_max_seconds = 60
@@ -1,169 +1,921 @@
-import os
-import json
-import threading
-from flask import Flask, request, jsonify, send_file, make_response
-import requests
-import shutil
-import time
-import config_param as cp
-
-app = Flask(__name__)
-
-class DataNode:
-    def __init__(self, id, host, port):
-        self.id = id
-        self.host = host
-        self.port = port
-
-# Define the directory for data blocks
-data_blocks_dir = cp.data_blocks_dir
-
-# Replica factor
-replication_factor = 3
-
-def register_with_namenode(name_node_url, host, port):
-    data = {'host': host, 'port': port}
-    print("registering with namenode: ", name_node_url)
-    print("sending request to the namenode-data: ", data)
-    response = requests.post(f'{name_node_url}/register', json=data)
-
-    if response.status_code == 200:
-        return response.json()['data_node']
-    else:
-        return None
-    
-def send_ping_acknowledgment_to_name_node(name_node_url, data_node_id):
-    acknowledgment_data = {
-        'data_node_id': data_node_id,
-        'status': 'active',
-    }
-
-    try:
-        response = requests.post(f'{name_node_url}/acknowledge_ping', json=acknowledgment_data)
-
-        if response.status_code == 200:
-            print(f"Acknowledgment sent to NameNode. Response: {response.json()}")
-        else:
-            print(f"Failed to send acknowledgment. Status Code: {response.status_code}")
-
-    except requests.RequestException as e:
-        print(f"Error sending acknowledgment to NameNode: {e}")
-
-def acknowledge_name_node_ping(name_node_url, data_node_id):
-    while True:
-        acknowledgment_data = {'data_node_id': data_node_id, 'status': 'active'}
-
-        try:
-            response = requests.post(f'{name_node_url}/acknowledge_ping', json=acknowledgment_data)
-
-            if response.status_code == 200:
-                print(f"Acknowledgment sent to NameNode for DataNode {data_node_id}")
-            else:
-                print(f"Failed to send acknowledgment to NameNode for DataNode {data_node_id}. Status Code: {response.status_code}")
-
-        except requests.RequestException as e:
-            print(f"Error sending acknowledgment to NameNode: {e}")
-
-        time.sleep(20)  # Adjust the interval as needed
-
-def store_data_block(data, block_id):
-    block_path = os.path.join(data_blocks_dir, str(block_id))
-    with open(block_path, 'wb') as block_file:
-        block_file.write(data)
-
-def retrieve_data_block(data_node_id, block_id):
-    #block_path = os.path.join(data_blocks_dir, str(block_id))
-    block_path = os.path.join(data_blocks_dir, f'datanode{data_node_id}', f'{block_id}')
-
-    block_path = r"{}".format(block_path)
-    print("Reading from:", block_path)
-    data = ""
-    try:
-        with open(block_path, 'rb') as block_file:
-            data = block_file.read()
-    except IOError as e:
-        return 404, ""
-
-    return 200, data
-
-def delete_data_block(block_id):
-    block_path = os.path.join(data_blocks_dir, str(block_id))
-    if os.path.exists(block_path):
-        os.remove(block_path)
-
-def send_acknowledgement(file_path, data_node_id):
-    data = {'file_path': file_path, 'data_node_id': data_node_id}
-    response = requests.post('http://127.0.0.1:5000/acknowledge_replication', json=data)
-    return response.status_code
-
-def replicate_data_block(data_block_path, source_data_node_id):
-    for data_node_id in range(1, replication_factor + 1):
-        if data_node_id != source_data_node_id:
-            destination_path = os.path.join(data_blocks_dir, f'datanode{data_node_id}', os.path.basename(data_block_path))
-            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-            shutil.copy(data_block_path, destination_path)
-
-@app.route('/handle_client_request', methods=['POST'])
-def handle_client_request():
-    data = request.json
-    operation = data.get('operation')
-    file_path = data.get('file_path')
-    data_node_id = data.get('data_node_id')
-    block_id = data.get('block_id')
-
-    if operation == 'read':
-        #data_block_path = os.path.join(data_blocks_dir, f'datanode{data_node_id}', f'{block_id}')
-        print("******data block:", retrieve_data_block(data_node_id, block_id))
-        (status, data_block) = retrieve_data_block(data_node_id, block_id)
-
-        data_block = data_block.decode()       
-        data = {"data_block": data_block}
-        # Create a custom response object
-        response = make_response(data, status)
-        # Set the content type to application/octet-stream
-        response.headers.set('Content-Type', 'application/octet-stream')
-        # Return the response object
-        return response
-
-    elif operation == 'write':
-        data_block_content = data.get('data_block_content')
-        write_data_block(data_node_id, block_id, data_block_content)
-        replicate_data_block(os.path.join(data_blocks_dir, f'datanode{data_node_id}', f'{block_id}'), data_node_id)
-        status = send_acknowledgement(file_path, data_node_id)
-        print("status from send_acknowledgement: ", status)
-        if status == 200:
-            #calling metadata_update
-            data = {'data_node_id': data_node_id, 'file_path': file_path, 'block_id': block_id}
-            response = requests.post(f'{name_node_url}/update_metadata', json=data)
-            print("response from metadata update: ", response)
-            status = response.status_code
-        
-        return jsonify({"status": status})
-
-
-def write_data_block(data_node_id, block_id, data_block_content):
-    data_block_path = os.path.join(data_blocks_dir, f'datanode{data_node_id}', f'{block_id}')
-    os.makedirs(os.path.dirname(data_block_path), exist_ok=True)
-    if isinstance(data_block_content, str):
-        data_block_content = data_block_content.encode('utf-8')
-    with open(data_block_path, 'wb') as file:
-        file.write(data_block_content)
-
-
-if __name__ == '__main__':
-    name_node_url = cp.name_node_url
-    data_node_host = cp.data_node_host
-    data_node_port = cp.data_node_port
-
-    data_node_id = register_with_namenode(name_node_url, data_node_host, data_node_port)
-
-    if data_node_id:
-        print(f"Registered with NameNode. Assigned Data Node ID: {data_node_id}")
-
-        ping_thread = threading.Thread(target=acknowledge_name_node_ping, args=(name_node_url, data_node_id))
-        ping_thread.daemon = True
-        ping_thread.start()
-
-        app.run(host='0.0.0.0', port=data_node_port)
-    else:
-        print("Failed to register with NameNode")
+import os
+import json
+import threading
+from flask import Flask, Response, request, jsonify
+import requests
+import queue
+import shutil
+import time
+import asyncio
+import signal
+import socket
+import socketserver
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_range_header
+import config_param as cp
+from checksum import BlockChecksum, ChecksumError, meta_path, read_verified
+from block_cache import BlockCache
+from logs import setup_logging
+import rpc
+import metrics
+import profiler
+
+try:
+    # Only needed when data_node_server = "aiohttp"
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = web = None
+
+app = Flask(__name__)
+rpc.install(app)
+metrics.install(app)
+profiler.install(app)
+log = logging.getLogger('datanode')
+
+class DataNode:
+    def __init__(self, id, host, port):
+        self.id = id
+        self.host = host
+        self.port = port
+
+# Define the directory for data blocks
+data_blocks_dir = cp.data_blocks_dir
+
+# Assigned by the NameNode on registration
+data_node_id = None
+
+def data_node_id_path():
+    # Kept beside the block directories, so the Data Node asks for the same ID, and so gets its own
+    # block directory back, after any restart of its own or of the NameNode
+    return os.path.join(data_blocks_dir, f'datanode_{cp.data_node_port}.id')
+
+def load_data_node_id():
+    try:
+        with open(data_node_id_path()) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_data_node_id(new_id):
+    global data_node_id
+    if data_node_id is not None and new_id != data_node_id:
+        log.warning("NameNode assigned ID %s instead of %s; blocks stored under the old ID are not reported",
+                    new_id, data_node_id)
+    data_node_id = new_id
+    tmp_path = data_node_id_path() + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(new_id))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, data_node_id_path())
+
+# Write load reported to the NameNode for block placement
+in_flight_writes = 0
+write_latency = 0.0
+write_stats_lock = threading.Lock()
+
+def load_report():
+    usage = shutil.disk_usage(data_blocks_dir)
+    return {'capacity': usage.total, 'free_space': usage.free,
+            'in_flight_writes': in_flight_writes, 'write_latency': write_latency}
+
+def register_with_namenode(name_node_url, host, port):
+    # Ask for the previous ID back so re-registering keeps the same block directory
+    data = {'host': host, 'port': port, 'rack': cp.data_node_rack, 'id': data_node_id}
+    data.update(load_report())
+    log.info("Registering with NameNode %s", name_node_url)
+    log.debug("Registration: %s", data)
+    response = rpc.post(f'{name_node_url}/register', data)
+
+    if response.status_code == 200:
+        return rpc.decode(response)['data_node']
+    else:
+        return None
+
+# Results of NameNode commands, piggybacked on the next heartbeat
+command_acks = []
+command_acks_lock = threading.Lock()
+
+def ack_command(command, block_id, status):
+    with command_acks_lock:
+        command_acks.append({'command': command, 'block_id': block_id, 'status': status})
+
+def send_heartbeats(name_node_url):
+    # The first full report went out when the Data Node registered
+    last_block_report = time.time()
+    while True:
+        with command_acks_lock:
+            acks = command_acks[:]
+            del command_acks[:]
+        heartbeat = {'data_node_id': data_node_id, 'load': load_report(), 'acks': acks}
+
+        try:
+            # The next heartbeat is the retry
+            response = rpc.post(f'{name_node_url}/heartbeat', heartbeat, retries=0, timeout=cp.heartbeat_interval)
+            if response.status_code == 200:
+                reply = rpc.decode(response)
+                if reply.get('reregister'):
+                    log.warning("NameNode asked Data Node %s to register again", data_node_id)
+                    data_node = register_with_namenode(name_node_url, cp.data_node_host, cp.data_node_port)
+                    if data_node:
+                        save_data_node_id(data_node['id'])
+                        send_block_report(name_node_url)
+                        last_block_report = time.time()
+                handle_commands(reply.get('commands', []))
+                acks = []
+                if time.time() - last_block_report >= cp.block_report_interval:
+                    send_block_report(name_node_url)
+                    last_block_report = time.time()
+            else:
+                log.warning("Failed to send heartbeat to NameNode for Data Node %s. Status Code: %s", data_node_id, response.status_code)
+
+        except requests.RequestException as e:
+            log.warning("Error sending heartbeat to NameNode: %s", e)
+
+        # Acks that didn't reach the NameNode go out with the next heartbeat
+        if acks:
+            with command_acks_lock:
+                command_acks[:0] = acks
+        time.sleep(cp.heartbeat_interval)
+
+class Throttle:
+    # Caps the combined rate of the transfers sharing it, in bytes per second
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, num_bytes):
+        with self.lock:
+            now = time.time()
+            start_time = max(self.next_time, now)
+            self.next_time = start_time + num_bytes / self.bytes_per_second
+        time.sleep(start_time - now)
+
+replication_pool = ThreadPoolExecutor(max_workers=cp.max_replication_streams)
+replication_throttle = Throttle(cp.replication_bandwidth)
+
+def handle_commands(commands):
+    for command in commands:
+        if command['command'] == 'replicate':
+            replication_pool.submit(replicate_block, command['block_id'], command['targets'])
+        elif command['command'] == 'delete' and command.get('quarantined'):
+            # The block has its good replicas back, so the corrupt copy kept aside can go
+            remove_quarantined_block(command['block_id'])
+        elif command['command'] == 'delete':
+            # No file references the block any more
+            delete_data_block(command['block_id'])
+        else:
+            log.warning("Unknown command from NameNode: %s", command)
+
+def replicate_block(block_id, targets):
+    # Copy a local block to the targets chosen by the NameNode, reusing the write pipeline
+    path = block_path(block_id)
+    if not os.path.exists(path):
+        log.warning("Cannot replicate block %s: not found", block_id, extra={'block_id': block_id})
+        ack_command('replicate', block_id, 'failed')
+        return
+
+    def body():
+        # Verified as it is read, so a corrupt replica is never copied
+        try:
+            for chunk in read_verified(path, read_size=cp.transfer_chunk_size):
+                replication_throttle.wait(len(chunk))
+                yield chunk
+        except ChecksumError as e:
+            quarantine_corrupt_block(block_id, e)
+            raise
+
+    params = {'targets': ','.join(targets[1:])}
+    try:
+        response = rpc.call('PUT', f'http://{targets[0]}/blocks/{block_id}', params=params, data=body(),
+                            headers={'Content-Type': 'application/octet-stream'}, retries=0, timeout=cp.pipeline_timeout)
+        log.info("Replicated block %s to %s. Status Code: %s", block_id, targets, response.status_code,
+                 extra={'block_id': block_id, 'status': response.status_code})
+        ack_command('replicate', block_id, 'done' if response.status_code == 200 else 'failed')
+    except (requests.RequestException, IOError) as e:
+        log.warning("Error replicating block %s to %s: %s", block_id, targets, e, extra={'block_id': block_id})
+        ack_command('replicate', block_id, 'failed')
+
+def block_path(block_id):
+    return os.path.join(data_blocks_dir, f'datanode{data_node_id}', block_id)
+
+def quarantine_path(block_id):
+    return block_path(block_id) + '.corrupt'
+
+def is_valid_block_id(block_id):
+    return (bool(block_id) and os.path.basename(block_id) == block_id and not block_id.startswith('.')
+            and not block_id.endswith(('.tmp', '.meta', '.corrupt')))
+
+def store_data_block(data, block_id):
+    path = block_path(block_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    checksum = BlockChecksum(cp.checksum_chunk_size)
+    checksum.update(data)
+    checksum.write(meta_path(path))
+    with open(path, 'wb') as block_file:
+        block_file.write(data)
+
+def remove_block_files(block_id):
+    path = block_path(block_id)
+    if not os.path.exists(path):
+        return False
+    os.remove(path)
+    if os.path.exists(meta_path(path)):
+        os.remove(meta_path(path))
+    block_cache.invalidate(block_id)
+    last_verified.pop(block_id, None)
+    return True
+
+def delete_data_block(block_id):
+    remove_quarantined_block(block_id)
+    if remove_block_files(block_id):
+        queue_block_notice(deleted=[block_id])
+
+def quarantine_block(block_id):
+    # Moves the replica and its .meta aside, where they are neither served nor reported as a replica
+    path = block_path(block_id)
+    if not os.path.exists(path):
+        return
+    # The block goes first: a block without its .meta would be served unverified
+    os.replace(path, quarantine_path(block_id))
+    if os.path.exists(meta_path(path)):
+        os.replace(meta_path(path), meta_path(quarantine_path(block_id)))
+    block_cache.invalidate(block_id)
+    last_verified.pop(block_id, None)
+
+def remove_quarantined_block(block_id):
+    path = quarantine_path(block_id)
+    for quarantined in (path, meta_path(path)):
+        if os.path.exists(quarantined):
+            os.remove(quarantined)
+
+def list_local_blocks():
+    block_dir = os.path.dirname(block_path('_'))
+    if not os.path.exists(block_dir):
+        return []
+    return [name for name in os.listdir(block_dir) if is_valid_block_id(name)]
+
+def list_quarantined_blocks():
+    block_dir = os.path.dirname(block_path('_'))
+    if not os.path.exists(block_dir):
+        return []
+    return [name[:-len('.corrupt')] for name in os.listdir(block_dir) if name.endswith('.corrupt')]
+
+# block_id -> time the whole block last passed a checksum check, by a read or the scrubber
+last_verified = {}
+
+def quarantine_corrupt_block(block_id, error):
+    # Stop serving the replica at once, but keep it: the damage may be in the .meta alone, or this may be
+    # the only copy. The NameNode re-replicates the block and tells us to delete it once that is done
+    log.error("Quarantining corrupt block %s: %s", block_id, error, extra={'block_id': block_id})
+    quarantine_block(block_id)
+    try:
+        rpc.post(f'{cp.name_node_url}/report_bad_blocks', {'data_node_id': data_node_id, 'blocks': [block_id]})
+    except requests.RequestException as e:
+        log.warning("Error reporting corrupt block %s: %s", block_id, e, extra={'block_id': block_id})
+        # The deleted notice still takes the replica out of the NameNode's block map
+        queue_block_notice(deleted=[block_id])
+
+scrub_throttle = Throttle(cp.scrub_bandwidth)
+
+def verify_block(block_id):
+    try:
+        for chunk in read_verified(block_path(block_id), read_size=cp.transfer_chunk_size):
+            scrub_throttle.wait(len(chunk))
+    except ChecksumError as e:
+        quarantine_corrupt_block(block_id, e)
+        return False
+    except FileNotFoundError:
+        # Deleted while the scrubber was on its way to it
+        return True
+    last_verified[block_id] = time.time()
+    return True
+
+def scrub_blocks():
+    # Re-verify blocks nobody has read in scrub_period, least recently verified first
+    while True:
+        time.sleep(cp.scrub_interval)
+        now = time.time()
+        for block_id in sorted(list_local_blocks(), key=lambda block_id: last_verified.get(block_id, 0)):
+            if now - last_verified.get(block_id, 0) < cp.scrub_period:
+                break
+            if not verify_block(block_id):
+                log.error("Scrubber found corrupt block %s", block_id, extra={'block_id': block_id})
+
+def block_ages(blocks):
+    # Seconds since each replica was written, for the NameNode's grace period on unreferenced ones
+    now = time.time()
+    ages = {}
+    for block_id in blocks:
+        try:
+            ages[block_id] = now - os.path.getmtime(block_path(block_id))
+        except FileNotFoundError:
+            pass
+    return ages
+
+def send_block_report(name_node_url):
+    blocks = list_local_blocks()
+    # Quarantined replicas are listed apart, so a restarted NameNode still gets them deleted in the end
+    response = rpc.post(f'{name_node_url}/block_report', {'data_node_id': data_node_id, 'blocks': blocks,
+                                                          'ages': block_ages(blocks),
+                                                          'corrupt': list_quarantined_blocks()})
+    log.info("Sent block report with %d blocks. Status Code: %s", len(blocks), response.status_code)
+
+def send_incremental_block_report(name_node_url, added=(), deleted=()):
+    # Returns False only if the report should be retried
+    data = {'data_node_id': data_node_id, 'added': list(added), 'deleted': list(deleted)}
+    try:
+        response = rpc.post(f'{name_node_url}/incremental_block_report', data, retries=0, timeout=cp.heartbeat_interval)
+        if response.status_code != 200:
+            # Not registered: the full block report sent on re-registering covers these blocks
+            log.warning("Failed to send block report. Status Code: %s", response.status_code)
+        return True
+    except requests.RequestException as e:
+        log.warning("Error sending block report to NameNode: %s", e)
+        return False
+
+# Blocks received or deleted since the last incremental block report
+received_blocks = []
+deleted_blocks = []
+block_notices = threading.Condition()
+
+def queue_block_notice(added=(), deleted=()):
+    with block_notices:
+        received_blocks.extend(added)
+        deleted_blocks.extend(deleted)
+        if len(received_blocks) + len(deleted_blocks) >= cp.block_report_batch_size:
+            block_notices.notify()
+
+def flush_block_notices(name_node_url):
+    with block_notices:
+        added, deleted = received_blocks[:], deleted_blocks[:]
+        del received_blocks[:]
+        del deleted_blocks[:]
+    if added or deleted:
+        send_incremental_block_report(name_node_url, added, deleted)
+
+def send_block_notices(name_node_url):
+    # Coalesces notices so a burst of block writes costs one NameNode round trip per batch
+    while True:
+        with block_notices:
+            block_notices.wait_for(lambda: len(received_blocks) + len(deleted_blocks) >= cp.block_report_batch_size,
+                                   timeout=cp.block_report_batch_interval)
+            added = received_blocks[:cp.block_report_batch_size]
+            deleted = deleted_blocks[:cp.block_report_batch_size]
+            del received_blocks[:len(added)]
+            del deleted_blocks[:len(deleted)]
+        if (added or deleted) and not send_incremental_block_report(name_node_url, added, deleted):
+            # Put the batch back in front and retry after the next interval
+            with block_notices:
+                received_blocks[:0] = added
+                deleted_blocks[:0] = deleted
+            time.sleep(cp.block_report_batch_interval)
+
+class ReplicaForwarder:
+    # Streams a block to the next Data Node in the write pipeline while it is written locally
+    def __init__(self, block_id, file_path, targets):
+        self.chunks = queue.Queue(maxsize=cp.pipeline_queue_depth)
+        self.replicas = None
+        self.thread = threading.Thread(target=self.run, args=(block_id, file_path, targets))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, block_id, file_path, targets):
+        next_target = targets[0]
+        params = {'file_path': file_path, 'targets': ','.join(targets[1:])}
+        try:
+            response = rpc.call('PUT', f'http://{next_target}/blocks/{block_id}', params=params, data=self.body(),
+                                headers={'Content-Type': 'application/octet-stream'}, retries=0, timeout=cp.pipeline_timeout)
+            if response.status_code == 200:
+                self.replicas = rpc.decode(response).get('replicas', [])
+            else:
+                log.warning("Replica %s rejected block %s. Status Code: %s", next_target, block_id, response.status_code,
+                            extra={'block_id': block_id})
+                self.replicas = []
+        except (requests.RequestException, IOError) as e:
+            log.warning("Error forwarding block %s to %s: %s", block_id, next_target, e, extra={'block_id': block_id})
+            self.replicas = []
+
+    def body(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                # Break the chunked stream so the downstream replica discards its partial block
+                raise chunk
+            yield chunk
+
+    def send(self, chunk):
+        # Stop feeding a downstream replica that has already failed instead of blocking the local write
+        while self.replicas is None:
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        self.send(None)
+        self.thread.join()
+        return self.replicas
+
+    def abort(self):
+        self.send(IOError('Upstream write failed'))
+        self.thread.join()
+
+# Pages of client reads, one transfer_chunk_size each
+block_cache = BlockCache(cp.block_cache_size)
+
+bytes_written = metrics.Counter('datanode_bytes_written_total', 'Block bytes written, from clients and other Data Nodes')
+bytes_read = metrics.Counter('datanode_bytes_read_total', 'Block bytes served to readers')
+active_transfers_gauge = metrics.Gauge('datanode_active_transfers', 'Block reads and writes in progress', ('direction',))
+
+def read_cached(block_id, path, start, stop):
+    # Serves [start, stop) page by page, reading and verifying only the pages not in the cache
+    page_size = cp.transfer_chunk_size
+    active_transfers_gauge.inc('read')
+    try:
+        for page in range(start // page_size, -(-stop // page_size)):
+            data, generation = block_cache.get(block_id, page)
+            if data is None:
+                data = b''.join(read_verified(path, page * page_size, (page + 1) * page_size, read_size=page_size))
+                block_cache.put(block_id, page, data, generation)
+            chunk = data[max(start - page * page_size, 0):stop - page * page_size]
+            bytes_read.inc(amount=len(chunk))
+            yield chunk
+    finally:
+        active_transfers_gauge.dec('read')
+
+class BlockWriter:
+    # Writes a block to a temp file, checksumming and forwarding it down the pipeline as it goes,
+    # so readers never see a partial block
+    def __init__(self, block_id, forwarder=None):
+        self.block_id = block_id
+        self.path = block_path(block_id)
+        self.tmp_path = self.path + '.tmp'
+        self.forwarder = forwarder
+        self.num_bytes = 0
+        self.checksum = BlockChecksum(cp.checksum_chunk_size)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.block_file = open(self.tmp_path, 'wb')
+
+    def write(self, chunk):
+        if self.forwarder:
+            self.forwarder.send(chunk)
+        self.block_file.write(chunk)
+        self.checksum.update(chunk)
+        self.num_bytes += len(chunk)
+        bytes_written.inc(amount=len(chunk))
+
+    def commit(self):
+        self.block_file.close()
+        # Checksums land first, so a block file is never visible without its .meta
+        self.checksum.write(meta_path(self.path))
+        replacing = os.path.exists(self.path)
+        os.replace(self.tmp_path, self.path)
+        if replacing:
+            block_cache.invalidate(self.block_id)
+        last_verified[self.block_id] = time.time()
+        return self.num_bytes
+
+    def abort(self):
+        self.block_file.close()
+        os.remove(self.tmp_path)
+
+def write_data_block(block_id, stream, forwarder=None):
+    writer = BlockWriter(block_id, forwarder)
+    try:
+        while True:
+            chunk = stream.read(cp.transfer_chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.commit()
+
+def start_write():
+    global in_flight_writes
+    with write_stats_lock:
+        in_flight_writes += 1
+    active_transfers_gauge.inc('write')
+    return time.time()
+
+def finish_write(start_time):
+    global in_flight_writes, write_latency
+    with write_stats_lock:
+        in_flight_writes -= 1
+        write_latency = 0.8 * write_latency + 0.2 * (time.time() - start_time)
+    active_transfers_gauge.dec('write')
+
+def resolve_range(byte_range, size):
+    # (start, stop, partial) for a parsed Range header, or None if it can't be satisfied
+    if byte_range is None:
+        return 0, size, False
+    bounds = byte_range.range_for_length(size)
+    return (*bounds, True) if bounds else None
+
+def pipeline_targets(args):
+    # Remaining Data Nodes in the pipeline, as host:port
+    return [target for target in args.get('targets', '').split(',') if target]
+
+@app.route('/blocks/<block_id>', methods=['PUT'])
+def put_block(block_id):
+    if not is_valid_block_id(block_id):
+        return jsonify({'status': 'error', 'message': 'Invalid block ID'}), 400
+    file_path = request.args.get('file_path')
+    targets = pipeline_targets(request.args)
+
+    start_time = start_write()
+    try:
+        forwarder = ReplicaForwarder(block_id, file_path, targets) if targets else None
+        try:
+            num_bytes = write_data_block(block_id, request.stream, forwarder)
+        except Exception:
+            if forwarder:
+                forwarder.abort()
+            raise
+        log.debug("Stored block %s (%d bytes)", block_id, num_bytes, extra={'block_id': block_id, 'bytes': num_bytes})
+        queue_block_notice(added=[block_id])
+
+        # Acknowledge only once every replica downstream has persisted the block
+        replicas = [data_node_id]
+        if forwarder:
+            replicas += forwarder.finish()
+    finally:
+        finish_write(start_time)
+    # The client commits the file's block list to the NameNode once every block is stored
+    return jsonify({'status': 'success', 'replicas': replicas})
+
+@app.route('/blocks/<block_id>', methods=['GET'])
+def get_block(block_id):
+    if not is_valid_block_id(block_id):
+        return jsonify({'status': 'error', 'message': 'Invalid block ID'}), 400
+    path = block_path(block_id)
+    if not os.path.exists(path):
+        return jsonify({'status': 'error', 'message': f'Block {block_id} not found'}), 404
+
+    # Pages are served from the cache or read and checked against the .meta checksums; a corrupt
+    # one breaks the response so the client fails over to another replica
+    size = os.path.getsize(path)
+    bounds = resolve_range(request.range, size)
+    if bounds is None:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    start, stop, partial = bounds
+
+    def body():
+        try:
+            yield from read_cached(block_id, path, start, stop)
+        except ChecksumError as e:
+            quarantine_corrupt_block(block_id, e)
+            raise
+        if (start, stop) == (0, size):
+            last_verified[block_id] = time.time()
+
+    response = Response(body(), status=206 if partial else 200, mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if partial:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    return response
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(block_cache.snapshot())
+
+
+# Short-circuit reads: a client on this host asks over a Unix socket for a block and gets its file and
+# .meta descriptors back, then mmaps and verifies the block itself instead of streaming it over HTTP
+short_circuit_reads = metrics.Counter('datanode_short_circuit_reads_total',
+                                      'Block files handed to local clients over the short-circuit socket')
+
+def open_short_circuit(request):
+    # Returns (reply, open files to pass), checked like a GET of the block
+    block_id = request.get('block_id')
+    if request.get('data_node_id') != data_node_id:
+        return {'status': 'error', 'message': 'Not this Data Node'}, []
+    if not is_valid_block_id(block_id):
+        return {'status': 'error', 'message': 'Invalid block ID'}, []
+    path = block_path(block_id)
+    try:
+        files = [open(path, 'rb')]
+    except FileNotFoundError:
+        return {'status': 'error', 'message': f'Block {block_id} not found'}, []
+    if os.path.exists(meta_path(path)):
+        files.append(open(meta_path(path), 'rb'))
+    return {'status': 'success'}, files
+
+class ShortCircuitHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        files = []
+        try:
+            reply, files = open_short_circuit(json.loads(self.rfile.readline(4096)))
+            socket.send_fds(self.request, [json.dumps(reply).encode()], [file.fileno() for file in files])
+            if files:
+                short_circuit_reads.inc()
+        except (ValueError, AttributeError, OSError) as e:
+            log.warning("Error handling short-circuit read: %s", e)
+        finally:
+            for file in files:
+                file.close()
+
+def open_short_circuit_server():
+    # Called before any other thread starts, since the umask that gives the socket its mode at bind
+    # time is process-wide; there is no window in which the socket is more open than configured
+    path = cp.short_circuit_socket.format(data_blocks_dir=data_blocks_dir, port=cp.data_node_port)
+    socket_dir = os.path.dirname(path)
+    os.makedirs(socket_dir, exist_ok=True)
+    os.chmod(socket_dir, cp.short_circuit_dir_mode)
+    if os.path.exists(path):
+        # Left behind by a previous run
+        os.remove(path)
+    old_umask = os.umask(0o777 & ~cp.short_circuit_socket_mode)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, ShortCircuitHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    log.info("Serving short-circuit reads on %s", path)
+    return server
+
+
+# Alternative server for data_node_server = "aiohttp", with the same block API. The event loop holds
+# the connections and a bounded pool does the disk I/O, so idle and slow clients don't tie up threads
+io_pool = ThreadPoolExecutor(max_workers=cp.async_io_threads)
+# Block transfers in progress, waited for on shutdown
+active_transfers = 0
+# Client for forwarding pipelined writes, open while the server runs
+forward_session = None
+
+def track_transfer(handler):
+    async def tracked(request):
+        global active_transfers
+        active_transfers += 1
+        try:
+            return await handler(request)
+        finally:
+            active_transfers -= 1
+    return tracked
+
+class AsyncReplicaForwarder:
+    # ReplicaForwarder for the event loop: chunks go through an asyncio queue to a streaming aiohttp
+    # request, so a slow downstream replica holds buffers rather than io_pool threads
+    def __init__(self, session, block_id, file_path, targets):
+        self.chunks = asyncio.Queue(maxsize=cp.pipeline_queue_depth)
+        self.replicas = None
+        self.task = asyncio.create_task(self.run(session, block_id, file_path, targets))
+
+    async def run(self, session, block_id, file_path, targets):
+        next_target = targets[0]
+        params = {'targets': ','.join(targets[1:])}
+        if file_path:
+            params['file_path'] = file_path
+        try:
+            async with session.put(f'http://{next_target}/blocks/{block_id}', params=params, data=self.body(),
+                                   headers={'Content-Type': 'application/octet-stream'},
+                                   timeout=aiohttp.ClientTimeout(total=cp.pipeline_timeout)) as response:
+                if response.status == 200:
+                    self.replicas = (await response.json(content_type=None)).get('replicas', [])
+                else:
+                    log.warning("Replica %s rejected block %s. Status Code: %s", next_target, block_id, response.status,
+                                extra={'block_id': block_id})
+                    self.replicas = []
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            log.warning("Error forwarding block %s to %s: %s", block_id, next_target, e, extra={'block_id': block_id})
+            self.replicas = []
+
+    async def body(self):
+        while True:
+            chunk = await self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                # Break the chunked stream so the downstream replica discards its partial block
+                raise chunk
+            yield chunk
+
+    async def send(self, chunk):
+        # Stop feeding a downstream replica that has already failed instead of blocking the local write
+        if self.task.done():
+            return
+        put = asyncio.ensure_future(self.chunks.put(chunk))
+        await asyncio.wait([put, self.task], return_when=asyncio.FIRST_COMPLETED)
+        put.cancel()
+
+    async def finish(self):
+        await self.send(None)
+        await self.task
+        return self.replicas
+
+    async def abort(self):
+        await self.send(IOError('Upstream write failed'))
+        await self.task
+
+async def async_put_block(request):
+    block_id = request.match_info['block_id']
+    if not is_valid_block_id(block_id):
+        return web.json_response({'status': 'error', 'message': 'Invalid block ID'}, status=400)
+    targets = pipeline_targets(request.query)
+    loop = asyncio.get_running_loop()
+
+    start_time = start_write()
+    try:
+        # Forwarding stays on the event loop; io_pool threads only write and checksum the local copy
+        forwarder = AsyncReplicaForwarder(forward_session, block_id, request.query.get('file_path'),
+                                          targets) if targets else None
+        try:
+            writer = await loop.run_in_executor(io_pool, BlockWriter, block_id)
+            try:
+                while True:
+                    chunk = await request.content.read(cp.transfer_chunk_size)
+                    if not chunk:
+                        break
+                    if forwarder:
+                        await forwarder.send(chunk)
+                    await loop.run_in_executor(io_pool, writer.write, chunk)
+            except BaseException:
+                await loop.run_in_executor(io_pool, writer.abort)
+                raise
+            num_bytes = await loop.run_in_executor(io_pool, writer.commit)
+        except BaseException:
+            if forwarder:
+                await forwarder.abort()
+            raise
+        log.debug("Stored block %s (%d bytes)", block_id, num_bytes, extra={'block_id': block_id, 'bytes': num_bytes})
+        queue_block_notice(added=[block_id])
+
+        replicas = [data_node_id]
+        if forwarder:
+            replicas += await forwarder.finish()
+    finally:
+        finish_write(start_time)
+    return web.json_response({'status': 'success', 'replicas': replicas})
+
+async def async_get_block(request):
+    block_id = request.match_info['block_id']
+    if not is_valid_block_id(block_id):
+        return web.json_response({'status': 'error', 'message': 'Invalid block ID'}, status=400)
+    path = block_path(block_id)
+    if not os.path.exists(path):
+        return web.json_response({'status': 'error', 'message': f'Block {block_id} not found'}, status=404)
+
+    size = os.path.getsize(path)
+    bounds = resolve_range(parse_range_header(request.headers.get('Range')), size)
+    if bounds is None:
+        return web.Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    start, stop, partial = bounds
+
+    response = web.StreamResponse(status=206 if partial else 200,
+                                  headers={'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'})
+    response.content_length = stop - start
+    if partial:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    await response.prepare(request)
+    if request.method == 'HEAD':
+        return response
+
+    loop = asyncio.get_running_loop()
+    pages = read_cached(block_id, path, start, stop)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(io_pool, next, pages, None)
+            if chunk is None:
+                break
+            # Waits for the client to drain, so a slow reader holds a buffer rather than a thread
+            await response.write(chunk)
+    except ChecksumError as e:
+        # Raising mid-body drops the connection, so the client fails over to another replica
+        await loop.run_in_executor(io_pool, quarantine_corrupt_block, block_id, e)
+        raise
+    finally:
+        pages.close()
+    if (start, stop) == (0, size):
+        last_verified[block_id] = time.time()
+    await response.write_eof()
+    return response
+
+async def async_cache_stats(request):
+    return web.json_response(block_cache.snapshot())
+
+async def async_metrics(request):
+    return web.Response(body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+async def async_profile(request):
+    if not cp.profiler_enabled:
+        return web.json_response({'status': 'error', 'message': 'Profiler is disabled'}, status=404)
+    seconds, interval, limit = profiler.profile_args(request.query)
+    counts = await asyncio.get_running_loop().run_in_executor(None, profiler.sample_stacks, seconds, interval)
+    return web.Response(text=profiler.collapsed(counts, limit))
+
+def request_metrics_middleware():
+    @web.middleware
+    async def record_request(request, handler):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            metrics.observe_request(resource.canonical if resource else 'unmatched', request.method, status,
+                                    time.perf_counter() - start)
+    return record_request
+
+async def open_forward_session(async_app):
+    # Not capped: every pipelined upload holds one downstream connection for as long as it lasts
+    global forward_session
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as forward_session:
+        yield
+
+def run_async_server(host, port, name_node_url):
+    if web is None:
+        raise SystemExit('data_node_server = "aiohttp" needs the aiohttp package')
+    async_app = web.Application(middlewares=[request_metrics_middleware()])
+    async_app.router.add_put('/blocks/{block_id}', track_transfer(async_put_block))
+    async_app.router.add_get('/blocks/{block_id}', track_transfer(async_get_block))
+    async_app.router.add_get('/cache_stats', async_cache_stats)
+    async_app.router.add_get('/metrics', async_metrics)
+    async_app.router.add_get('/debug/profile', async_profile)
+    async_app.cleanup_ctx.append(open_forward_session)
+
+    async def serve():
+        runner = web.AppRunner(async_app, shutdown_timeout=cp.async_shutdown_timeout)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port, backlog=cp.async_backlog)
+        await site.start()
+        log.info("Serving blocks on %s:%s with aiohttp", host, port)
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        await stopping.wait()
+
+        # Stop accepting, let in-flight transfers finish, then report the blocks they stored. The wait
+        # comes before runner.cleanup(), which stops reading request bodies and would cut uploads short
+        log.info("Draining %d in-flight transfers", active_transfers)
+        await site.stop()
+        deadline = loop.time() + cp.async_shutdown_timeout
+        while active_transfers and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        await runner.cleanup()
+        await loop.run_in_executor(None, flush_block_notices, name_node_url)
+        io_pool.shutdown(wait=True)
+
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    setup_logging()
+    name_node_url = cp.name_node_url
+    data_node_host = cp.data_node_host
+    data_node_port = cp.data_node_port
+    os.makedirs(data_blocks_dir, exist_ok=True)
+
+    short_circuit_server = None
+    if cp.short_circuit_reads and hasattr(socket, 'send_fds'):
+        try:
+            short_circuit_server = open_short_circuit_server()
+        except OSError as e:
+            log.warning("Short-circuit reads disabled: %s", e)
+
+    data_node_id = load_data_node_id()
+    data_node = register_with_namenode(name_node_url, data_node_host, data_node_port)
+
+    if data_node:
+        save_data_node_id(data_node['id'])
+        log.info("Registered with NameNode. Assigned Data Node ID: %s", data_node_id)
+        send_block_report(name_node_url)
+
+        heartbeat_thread = threading.Thread(target=send_heartbeats, args=(name_node_url,))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        block_notice_thread = threading.Thread(target=send_block_notices, args=(name_node_url,))
+        block_notice_thread.daemon = True
+        block_notice_thread.start()
+
+        scrubber_thread = threading.Thread(target=scrub_blocks)
+        scrubber_thread.daemon = True
+        scrubber_thread.start()
+
+        if short_circuit_server:
+            short_circuit_thread = threading.Thread(target=short_circuit_server.serve_forever)
+            short_circuit_thread.daemon = True
+            short_circuit_thread.start()
+
+        if cp.data_node_server == 'aiohttp':
+            run_async_server('0.0.0.0', data_node_port, name_node_url)
+        else:
+            app.run(host='0.0.0.0', port=data_node_port)
+    else:
+        log.error("Failed to register with NameNode")
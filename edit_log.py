@@ -0,0 +1,133 @@
+import os
+import json
+import threading
+import logging
+import metrics
+
+log = logging.getLogger('edit_log')
+sync_time = metrics.Histogram('namenode_edit_log_sync_seconds', 'Time to flush and fsync the edit log, once per group commit')
+edits_total = metrics.Counter('namenode_edits_total', 'Edits appended to the edit log')
+
+
+class EditLogError(IOError):
+    pass
+
+
+class EditLog:
+    def __init__(self, path, txid=0):
+        self.path = path
+        self.txid = txid
+        self.synced_txid = txid
+        self.edits_since_checkpoint = 0
+        self.lock = threading.Lock()
+        # Held by the one thread flushing the log; the others wait for it and usually find their edit synced
+        self.sync_lock = threading.Lock()
+        # New edits must not land after a torn line, where the next replay would stop before them
+        truncate_torn_tail(path)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def append(self, edit):
+        # Buffered only; callers must sync(txid) before acknowledging the edit
+        with self.lock:
+            self.txid += 1
+            edit = dict(edit, txid=self.txid)
+            self.file.write(json.dumps(edit) + '\n')
+            self.edits_since_checkpoint += 1
+            edits_total.inc()
+            return self.txid
+
+    def sync(self, txid):
+        # Group commit: one fsync makes every edit appended so far durable
+        with self.sync_lock:
+            if self.synced_txid >= txid:
+                return
+            with sync_time.time():
+                with self.lock:
+                    self.file.flush()
+                    last_txid = self.txid
+                os.fsync(self.file.fileno())
+            self.synced_txid = last_txid
+
+    def roll(self):
+        # Finalize the current segment as <path>.<last txid> and start a new one
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced_txid = self.txid
+            self.file.close()
+            segment_path = f'{self.path}.{self.txid}'
+            os.replace(self.path, segment_path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+            self.edits_since_checkpoint = 0
+            return segment_path
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.file.close()
+
+
+def list_segments(path):
+    directory, name = os.path.split(path)
+    segments = []
+    for entry in os.listdir(directory or '.'):
+        suffix = entry[len(name) + 1:]
+        if entry.startswith(name + '.') and suffix.isdigit():
+            segments.append((int(suffix), os.path.join(directory, entry)))
+    return sorted(segments)
+
+
+def parse_edit(line):
+    # None for a line a crash cut short: every complete edit ends with a newline
+    if not line.endswith(b'\n'):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def truncate_torn_tail(path):
+    # Cuts the in-progress log back to the end of its last complete edit
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        valid_end = 0
+        for line in f:
+            if parse_edit(line) is None:
+                break
+            valid_end += len(line)
+        size = f.seek(0, os.SEEK_END)
+        if valid_end < size:
+            log.warning("Truncating %d bytes of torn edits at the end of %s", size - valid_end, path)
+            f.truncate(valid_end)
+            os.fsync(f.fileno())
+
+
+def read_edits(path, after_txid=0, upto_txid=None):
+    # Replay finalized segments first, then the in-progress log. With upto_txid, only the finalized
+    # segments up to that txid are read
+    paths = [segment_path for last_txid, segment_path in list_segments(path)
+             if last_txid > after_txid and (upto_txid is None or last_txid <= upto_txid)]
+    if upto_txid is None and os.path.exists(path):
+        paths.append(path)
+
+    for edit_path in paths:
+        with open(edit_path, 'rb') as f:
+            lines = iter(f)
+            for line in lines:
+                edit = parse_edit(line)
+                if edit is None:
+                    # Only the last line of the in-progress log can be torn, by a crash mid-write; it
+                    # was never acknowledged. Anywhere else a bad line means edits would be lost
+                    if edit_path != path or next(lines, None) is not None:
+                        raise EditLogError(f"Corrupt edit in {edit_path} at {line[:80]!r}")
+                    log.warning("Ignoring truncated edit in %s", edit_path)
+                    break
+                if edit['txid'] > after_txid:
+                    yield edit
+
+
+def purge_segments(path, upto_txid):
+    for last_txid, segment_path in list_segments(path):
+        if last_txid <= upto_txid:
+            os.remove(segment_path)
@@ -0,0 +1,33 @@
+import json
+import logging
+import time
+import config_param as cp
+
+# Attributes every LogRecord has; anything else was passed in extra= and is logged as a field
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line: time, level, logger, message and any extra= fields
+    def format(self, record):
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+                 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging():
+    # Called once by each server at startup; messages below log_level are never formatted
+    handler = logging.StreamHandler()
+    if cp.log_format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(cp.log_level)
+    # werkzeug and aiohttp log a line per request at INFO
+    for name in ('werkzeug', 'aiohttp.access'):
+        logging.getLogger(name).setLevel(cp.log_level if cp.access_log else logging.WARNING)
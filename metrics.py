@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, g, request
+
+# Prometheus text exposition of this process's metrics, without a client library dependency
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, kind, name, documentation, labelnames=()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value, *extra in self.samples():
+            lines.append(f'{name}{format_labels(self.labelnames, labels, *extra)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__('counter', name, documentation, labelnames)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    # function, if given, is called at scrape time and returns {label values: value}
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__('gauge', name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.function:
+            return [(self.name, labels, value) for labels, value in self.function().items()]
+        return super().samples()
+
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__('histogram', name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', labels, cumulative, [('le', format_value(bound))]))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+def render():
+    lines = []
+    for metric in list(registry):
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+request_latency = Histogram('http_request_duration_seconds', 'Time from receiving a request until its response is sent',
+                            ('route', 'method'))
+requests_total = Counter('http_requests_total', 'Requests handled, by route, method and status', ('route', 'method', 'status'))
+
+
+def observe_request(route, method, status, elapsed):
+    request_latency.observe(elapsed, route, method)
+    requests_total.inc(route, method, str(status))
+
+
+def install(app):
+    # Times every request by its route pattern, so /blocks/<block_id> is one series, and serves /metrics
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        # Recorded when the response is closed, so streamed block transfers are timed to their last byte
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method, start = request.method, g.request_start
+        response.call_on_close(lambda: observe_request(route, method, response.status_code, time.perf_counter() - start))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
@@ -1,369 +1,1166 @@
-import os
-import json
-import time
-import threading
-import uuid
-from flask import Flask, request, jsonify
-import config_param as cp
-
-app = Flask(__name__)
-
-class DataNode:
-    def __init__(self, id, host, port):
-        self.id = id
-        self.host = host
-        self.port = port
-        self.last_ping_time = time.time()
-        self.files = set()
-
-    def serialize(self):
-        return {'id': self.id, 'host': self.host, 'port': self.port, 'files': list(self.files)}
-
-# Define the directories for metadata, data blocks, and Data Node health tracking
-metadata_dir = cp.metadata_dir
-
-def initialize_metadata():
-    if not os.path.exists(metadata_dir):
-        os.makedirs(metadata_dir)
-
-    metadata_file = os.path.join(metadata_dir, cp.metadata_file_name)
-    if not os.path.exists(metadata_file):
-        metadata = {
-            '/': {  # Root directory metadata
-                'type': 'directory',
-                'files': {},
-            }
-        }
-        save_metadata(metadata)
-
-def save_metadata(metadata):
-    metadata_file = os.path.join(metadata_dir, cp.metadata_file_name)
-    with open(metadata_file, 'w') as f:  
-        json.dump(metadata, f)
-
-def load_metadata():
-    metadata_file = os.path.join(metadata_dir, cp.metadata_file_name)
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as f:
-            return json.load(f)
-    else:
-        return {}
-
-def update_metadata(file_path, block_id, data_node_id):
-    metadata = load_metadata()
-    if file_path not in metadata['/']['files']:
-        file_path = file_path.replace('\\\\', '\\')
-        metadata['/']['files'][file_path] = {'type': 'file', 'blocks': []}
-
-    metadata['/']['files'][file_path]['blocks'].append({'block_id': block_id, 'data_node_id': data_node_id})
-    save_metadata(metadata)
-
-@app.route('/update_metadata', methods=['POST'])
-def update_metadata_route():
-    print("got an update_metadata request: ", request.json)
-    data = request.json
-    data_node_id = data.get('data_node_id')
-    file_path = data.get('file_path')
-    block_id = data.get('block_id')
-
-    update_metadata(file_path, block_id, data_node_id)
-    return jsonify({'message': 'Metadata updated'}), 200
-
-data_nodes = {}
-
-def ping_data_nodes():
-    global data_nodes
-    while True:
-        if not data_nodes:
-            time.sleep(10)
-            continue
-
-        for data_node_id in list(data_nodes.keys()):
-            last_ping_time = data_nodes[data_node_id].last_ping_time
-            if time.time() - last_ping_time > 60:
-                handle_data_node_failure(data_node_id)
-                del data_nodes[data_node_id]
-            else:
-                # Update the last_ping_time for active Data Nodes
-                data_nodes[data_node_id].last_ping_time = time.time()
-
-        time.sleep(10)
-
-
-# Start the Data Node ping thread
-ping_thread = threading.Thread(target=ping_data_nodes)
-ping_thread.daemon = True
-ping_thread.start()
-
-def check_data_node_health():
-    while True:
-        for data_node_id, data_node in data_nodes.items():
-            if not ping_data_nodes(data_node):
-                handle_data_node_failure(data_node_id)
-            else:
-                data_node.last_ping_time = time.time()
-        time.sleep(60)
-
-# Define connected_clients globally
-connected_clients = {}
-
-def check_client_health():
-    while True:
-        current_time = time.time()
-        for client_id, last_ping_time in list(connected_clients.items()):
-            if current_time - last_ping_time > 60:
-                print(f"Client {client_id} is considered offline.")
-                del connected_clients[client_id]
-        time.sleep(30)
-
-# Start the client health check thread
-health_check_thread = threading.Thread(target=check_client_health)
-health_check_thread.daemon = True
-health_check_thread.start()
-
-@app.route('/ping', methods=['POST'])
-def client_ping():
-    client_id = request.json.get('client_id')
-    if client_id:
-        connected_clients[client_id] = time.time()
-        return jsonify({'status': 'success'})
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid client ID'}), 400
-
-@app.route('/create_file', methods=['POST'])
-def create_new_file():
-    data = request.json
-    file_path = data.get('file_path')
-    print(file_path)
-    if file_path:
-        # Check if the file already exists
-        metadata = load_metadata()
-        if file_path not in metadata:
-            # File doesn't exist, proceed with creation
-            file_id = create_file(file_path)
-            return jsonify({'status': 'success', 'file_id': file_id})
-        else:
-            return jsonify({'status': 'error', 'message': 'File already exists'}), 400
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
-
-# Function to create a new file in metadata
-def create_file(file_path):
-    file_id = str(uuid.uuid4())
-    update_metadata(file_path, file_id, 0)
-    return file_id
-
-@app.route('/get_file_metadata', methods=['GET'])
-def get_file_metadata():
-    data = request.json
-    file_path = data.get('file_path')
-    file_path = r"{}".format(file_path)
-    metadata = load_metadata()
-
-    if file_path:
-        files = metadata.get("/").get("files")
-        if file_path in files:
-            return jsonify({'status': 'success', 'metadata': files.get(file_path)})
-        else:
-            return jsonify({'status': 'error', 'message': 'File not found'}), 404
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
-
-
-@app.route('/delete_file', methods=['POST'])
-def delete_file():
-    data = request.json
-    file_path = data.get('file_path')
-
-    if file_path:
-        delete_status = delete_file_from_metadata(file_path)
-        if delete_status:
-            return jsonify({'status': 'success', 'message': f'File {file_path} deleted successfully'})
-        else:
-            return jsonify({'status': 'error', 'message': f'File {file_path} not found'}), 404
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
-
-# Function to delete a file from metadata
-def delete_file_from_metadata(file_path):
-    metadata = load_metadata()
-    print("metadata: ", metadata)
-
-    if file_path in metadata:
-        print("deleting file: ", file_path)
-        del metadata[file_path]
-        save_metadata(metadata)
-        return True
-    else:
-        return False
-
-@app.route('/move_file', methods=['POST'])
-def move_file():
-    data = request.json
-    src_path = data.get('src_path')
-    dest_path = data.get('dest_path')
-
-    if src_path and dest_path:
-        move_status = move_file_in_metadata(src_path, dest_path)
-        if move_status:
-            return jsonify({'status': 'success', 'message': f'File moved from {src_path} to {dest_path}'})
-        else:
-            return jsonify({'status': 'error', 'message': f'Error moving file or file not found'}), 404
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid source or destination path'}), 400
-
-# Function to move a file in metadata
-def move_file_in_metadata(src_path, dest_path):
-    metadata = load_metadata()
-
-    if src_path in metadata:
-        file_metadata = metadata[src_path]
-        metadata[dest_path] = file_metadata
-        del metadata[src_path]
-        save_metadata(metadata)
-        return True
-    else:
-        return False
-
-
-@app.route('/copy_file', methods=['POST'])
-def copy_file():
-    data = request.json
-    src_path = data.get('src_path')
-    dest_path = data.get('dest_path')
-
-    if src_path and dest_path:
-        copy_status = copy_file_in_metadata(src_path, dest_path)
-        if copy_status:
-            return jsonify({'status': 'success', 'message': f'File copied from {src_path} to {dest_path}'}), 200
-        else:
-            return jsonify({'status': 'error', 'message': f'Error copying file or file not found'}), 404
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid source or destination path'}), 400
-
-# Function to copy a file in metadata
-def copy_file_in_metadata(src_path, dest_path):
-    metadata = load_metadata()
-    print("metadata: ", metadata)
-    print("src_path: ", src_path)
-    print("dest_path: ", dest_path)
-
-    if src_path in metadata:
-        print("copying file: ", src_path)
-        file_metadata = metadata[src_path]
-        metadata[dest_path] = file_metadata.copy()
-        save_metadata(metadata)
-        return True
-    else:
-        return False
-
-
-@app.route('/register', methods=['POST'])
-def register_data_node():
-    global data_nodes  # Add this line to reference the global variable
-    
-    print("got a register request: ", request.json)
-    data = request.json
-    if 'host' in data and 'port' in data:
-        if 'data_nodes' not in globals():
-            data_nodes = {}
-        data_node = DataNode(len(data_nodes) + 1, data['host'], data['port'])
-        data_nodes[data_node.id] = data_node
-        print(f"Registered DataNode: {data_node.serialize()}")
-        print("data_nodes: ", data_nodes)
-        return jsonify({'status': 'success', 'data_node': data_node.serialize()})
-    else:
-        print('Invalid data node information')
-        return jsonify({'status': 'error', 'message': 'Invalid data node information'}), 400
-
-@app.route('/acknowledge_ping', methods=['POST'])
-def acknowledge_ping():
-    data = request.json
-    data_node_info = data.get('data_node_id')
-    status = data.get('status')
-
-    if status == 'active':
-        # Assume that the ping interval should be 60 seconds for active DataNodes
-        new_ping_interval = 20
-        update_ping_interval(data_node_info, new_ping_interval)
-        print(f"Received acknowledgment from DataNode {data_node_info['id']}: {status}. Updated ping interval to {new_ping_interval} seconds.")
-    else:
-        print(f"Received acknowledgment from DataNode {data_node_info['id']}: {status}.")
-
-    return jsonify({'message': 'Acknowledgment received'}), 200
-
-def update_ping_interval(data_node_info, new_ping_interval):
-    data_node_id = data_node_info['id']
-    if data_node_id in data_nodes:
-        data_nodes[data_node_id].ping_interval = new_ping_interval
-    else:
-        print(f"DataNode {data_node_id} not found.")
-
-@app.route('/acknowledge_replication', methods=['POST'])
-def acknowledge_replication():
-    data = request.json
-    data_node_id = data.get('data_node_id')
-    file_path = data.get('file_path')
-    return jsonify({'message': 'Acknowledgment replication received'}), 200
-
-@app.route('/metadata', methods=['GET'])
-def get_metadata():
-    print("data_nodes: ", data_nodes)
-    metadata = {'data_nodes': [node.serialize() for node in data_nodes.values()]}
-    app.logger.info('Retrieved metadata')
-    return jsonify(metadata)
-
-
-
-def handle_data_node_failure(offline_data_node_id):
-    print(f"Data Node {offline_data_node_id} is considered dead.")
-    replicas_metadata = get_replicas_metadata(offline_data_node_id)
-    update_metadata_replicas(replicas_metadata)
-
-def get_replicas_metadata(offline_data_node_id):
-    replicas_metadata = {}
-    for data_node_id, data_node in data_nodes.items():
-        if data_node_id != offline_data_node_id:
-            for file_path in data_node.files:
-                if file_path not in replicas_metadata:
-                    replicas_metadata[file_path] = []
-                replicas_metadata[file_path].append(file_path)
-
-    return replicas_metadata
-
-def update_metadata_replicas(replicas_metadata):
-    for replica, blocks in replicas_metadata.items():
-        update_metadata(replica, blocks)
-
-def resolve_file_path(file_path):
-    metadata = load_metadata()
-    if file_path in metadata:
-        data_blocks = metadata[file_path]
-        return data_blocks
-    else:
-        return None
-
-def send_data_block_to_client(file_path):
-    data_nodes_metadata = resolve_file_path(file_path)
-    print(f"Sending Data Node metadata for file {file_path} to the client: {data_nodes_metadata}")
-
-@app.route('/list_files', methods=['GET'])
-def list_files():
-    metadata = load_metadata()
-    files_list = list_files_recursive(metadata['/'])
-    return jsonify({'files': files_list})
-
-def list_files_recursive(directory):
-    files_list = []
-    for name, content in directory['files'].items():
-        if content['type'] == 'file':
-            files_list.append(name)
-        elif content['type'] == 'directory':
-            subdir_files = list_files_recursive(content)
-            files_list.extend([os.path.join(name, file) for file in subdir_files])
-    return files_list
-
-
-if __name__ == '__main__':
-    initialize_metadata()
-    app.run(host=cp.name_node_host, port=cp.name_node_port)
+import os
+import json
+import time
+import threading
+import uuid
+import fnmatch
+import heapq
+import itertools
+import logging
+from collections import Counter, defaultdict, deque
+from flask import Flask, Response, request, jsonify
+import config_param as cp
+from edit_log import EditLog, EditLogError, read_edits, purge_segments
+from timing_wheel import TimingWheel
+from namespace import Namespace, split_path, join_path
+from rwlock import RWLock
+from logs import setup_logging
+import rpc
+import metrics
+import profiler
+
+app = Flask(__name__)
+rpc.install(app)
+metrics.install(app)
+profiler.install(app)
+log = logging.getLogger('namenode')
+
+class DataNode:
+    def __init__(self, id, host, port, rack=None):
+        self.id = id
+        self.host = host
+        self.port = port
+        self.rack = rack or '/default-rack'
+        self.last_ping_time = time.time()
+        # IDs of the blocks this node holds, kept current by block reports
+        self.blocks = set()
+        # Load reported by the Data Node with each ping
+        self.capacity = None
+        self.free_space = None
+        self.in_flight_writes = 0
+        self.write_latency = 0.0
+        # Blocks allocated to the node since its last report
+        self.pending_writes = 0
+
+    def serialize(self):
+        return {'id': self.id, 'host': self.host, 'port': self.port, 'rack': self.rack, 'num_blocks': len(self.blocks)}
+
+    def update_load(self, report):
+        self.capacity = report.get('capacity', self.capacity)
+        self.free_space = report.get('free_space', self.free_space)
+        self.in_flight_writes = report.get('in_flight_writes', self.in_flight_writes)
+        self.write_latency = report.get('write_latency', self.write_latency)
+        self.pending_writes = 0
+
+# Define the directories for metadata, data blocks, and Data Node health tracking
+metadata_dir = cp.metadata_dir
+metadata_file = os.path.join(metadata_dir, cp.metadata_file_name)
+edit_log_file = os.path.join(metadata_dir, cp.edit_log_file_name)
+
+# The in-memory namespace is the source of truth; metadata.json is only a checkpoint
+namespace = Namespace()
+# block_id -> highest replication factor among the files referencing it
+expected_replication = {}
+# block_id -> Counter of the replication factors of the files referencing it, so a release can lower the max
+replication_refs = {}
+# block_id -> number of files referencing it, since copies share blocks
+block_refs = Counter()
+# Container block_id -> {'size', 'entries': {inode ID: (offset, length)}} for small files packed into it
+containers = {}
+# Content fingerprint -> entry of a live block with that content, so uploads can reuse it
+fingerprints = {}
+# Blocks whose last reference went away in the edit being applied, and (txid, block IDs) waiting for
+# that edit to be synced before their replicas are deleted
+released_blocks = []
+pending_deletions = deque()
+# Reads share the namespace; each mutation validates, logs and applies under the write lock
+namespace_lock = RWLock()
+# Guards the Data Node registry, block_map and replication state; taken after namespace_lock
+block_lock = threading.RLock()
+edit_log = None
+
+def initialize_metadata():
+    global edit_log
+    if not os.path.exists(metadata_dir):
+        os.makedirs(metadata_dir)
+
+    txid, replayed = load_namespace()
+    edit_log = EditLog(edit_log_file, txid)
+    edit_log.edits_since_checkpoint = replayed
+
+    checkpoint_thread = threading.Thread(target=checkpoint_metadata)
+    checkpoint_thread.daemon = True
+    checkpoint_thread.start()
+
+def load_namespace():
+    # The latest checkpoint plus every edit logged since, with the block indexes rebuilt from scratch
+    global namespace
+    for index in (expected_replication, replication_refs, block_refs, containers, fingerprints):
+        index.clear()
+    txid, namespace = load_metadata()
+    for _, inode in namespace.files(namespace.root):
+        reference_blocks(inode['blocks'], inode['replication'], inode['id'])
+
+    replayed = 0
+    for edit in read_edits(edit_log_file, txid):
+        apply_edit(edit)
+        txid = edit['txid']
+        replayed += 1
+    log.info("Loaded namespace at txid %d (%d edits replayed)", txid, replayed, extra={'txid': txid, 'replayed': replayed})
+    return txid, replayed
+
+checkpoint_time = metrics.Histogram('namenode_checkpoint_seconds', 'Time to snapshot and persist the namespace')
+
+def save_metadata():
+    with checkpoint_time.time():
+        checkpoint()
+
+def checkpoint():
+    # Only the roll happens under the lock. Like a secondary NameNode, the snapshot is built apart from
+    # the live namespace, by replaying the rolled segments onto the previous checkpoint
+    with namespace_lock.read():
+        if edit_log.edits_since_checkpoint == 0:
+            return
+        txid = edit_log.txid
+        edit_log.roll()
+
+    base_txid, target = load_metadata()
+    replayed_txid = base_txid
+    for edit in read_edits(edit_log_file, base_txid, txid):
+        apply_edit(edit, target)
+        replayed_txid = edit['txid']
+    # Purging the segments of a checkpoint that stopped short would lose the edits it skipped
+    if replayed_txid != txid:
+        raise EditLogError(f"Rolled edits end at txid {replayed_txid}, the checkpoint is at {txid}")
+    snapshot = json.dumps({'txid': txid, 'namespace': target.snapshot()})
+    tmp_file = metadata_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(snapshot)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, metadata_file)
+    purge_segments(edit_log_file, txid)
+    log.info("Checkpointed namespace at txid %d", txid, extra={'txid': txid})
+
+def load_metadata():
+    if os.path.exists(metadata_file):
+        with open(metadata_file, 'r') as f:
+            snapshot = json.load(f)
+        if 'namespace' not in snapshot:
+            # Pre edit-log metadata.json holds the bare namespace
+            return 0, migrate_flat_namespace(snapshot)
+        if 'root' not in snapshot['namespace']:
+            return snapshot['txid'], migrate_flat_namespace(snapshot['namespace'])
+        return snapshot['txid'], Namespace(snapshot['namespace'])
+    else:
+        return 0, Namespace()
+
+def migrate_flat_namespace(metadata):
+    # Earlier versions kept every file as a flat path key under '/'
+    migrated = Namespace()
+    for file_path, entry in metadata.get('/', {}).get('files', {}).items():
+        parts = split_path(file_path)
+        if entry.get('type') == 'file' and migrated.can_create(parts):
+            inode = migrated.create_file(parts)
+            inode['blocks'] = entry.get('blocks', [])
+            inode['replication'] = entry.get('replication')
+    return migrated
+
+def checkpoint_metadata():
+    while True:
+        time.sleep(cp.checkpoint_interval)
+        try:
+            save_metadata()
+        except OSError as e:
+            log.error("Checkpoint failed: %s", e)
+
+def log_edit(edit):
+    # Called under the namespace write lock. The caller syncs the returned txid after releasing
+    # the lock, so concurrent mutations share one fsync
+    txid = edit_log.append(edit)
+    del released_blocks[:]
+    apply_edit(edit)
+    if released_blocks:
+        pending_deletions.append((txid, released_blocks[:]))
+    return txid
+
+def delete_released_blocks():
+    # Called after a sync: replicas of blocks no file references any more are deleted once the edit
+    # that released them is durable, so a replayed log never points at a deleted block
+    with block_lock:
+        while pending_deletions and pending_deletions[0][0] <= edit_log.synced_txid:
+            _, block_ids = pending_deletions.popleft()
+            delete_block_replicas(block_ids)
+
+def delete_block_replicas(block_ids):
+    for block_id in block_ids:
+        if block_refs[block_id] > 0:
+            continue
+        pending_replications.pop(block_id, None)
+        for data_node_id in block_map.get(block_id, ()):
+            pending_commands[data_node_id].append({'command': 'delete', 'block_id': block_id})
+        release_corrupt_replicas(block_id)
+
+def apply_edit(edit, target=None):
+    # Edits are validated before they are logged, so applying one cannot fail. With a target, only
+    # that namespace changes and the live block indexes are left alone, for building a checkpoint
+    tree = namespace if target is None else target
+    tracked = target is None
+    op = edit['op']
+    if op == 'mkdir':
+        tree.mkdirs(split_path(edit['path']))
+    elif op == 'create':
+        tree.create_file(split_path(edit['file_path']))
+    elif op == 'add_block':
+        inode = file_inode_for_write(tree, split_path(edit['file_path']))
+        block = {'block_id': edit['block_id'], 'data_node_id': edit['data_node_id']}
+        inode['blocks'].append(block)
+        inode['generation'] = inode.get('generation', 0) + 1
+        if tracked:
+            reference_blocks([block], inode['replication'], inode['id'])
+    elif op == 'add_blocks':
+        for block in edit['blocks']:
+            apply_edit(dict(block, op='add_block'), target)
+    elif op == 'commit_file':
+        inode = file_inode_for_write(tree, split_path(edit['file_path']))
+        replace_blocks(inode, edit['blocks'], tracked)
+        inode['replication'] = edit.get('replication')
+        if tracked:
+            reference_blocks(inode['blocks'], inode['replication'], inode['id'])
+    elif op == 'commit_packed':
+        for packed in edit['files']:
+            block = dict(edit['container'], offset=packed['offset'], size=packed['length'],
+                         container_size=edit['container']['size'])
+            apply_edit({'op': 'commit_file', 'file_path': packed['file_path'], 'blocks': [block],
+                        'replication': edit.get('replication')}, target)
+    elif op == 'repack':
+        # Entries whose file was deleted or rewritten since the compaction read them are skipped
+        for entry in edit['entries']:
+            inode = tree.inodes.get(entry['inode_id'])
+            if inode and packed_range(inode) == (edit['old_block_id'], entry['offset'], entry['length']):
+                block = dict(edit['container'], offset=entry['new_offset'], size=entry['length'],
+                             container_size=edit['container']['size'])
+                replace_blocks(inode, [block], tracked)
+                if tracked:
+                    reference_blocks(inode['blocks'], inode['replication'], inode['id'])
+    elif op == 'delete':
+        removed = tree.remove(split_path(edit['file_path']))
+        if tracked:
+            for _, inode in tree.files(removed):
+                release_blocks(inode['blocks'], inode['replication'], inode['id'])
+    elif op == 'move':
+        tree.move(split_path(edit['src_path']), split_path(edit['dest_path']))
+    elif op == 'copy':
+        copied = tree.copy(split_path(edit['src_path']), split_path(edit['dest_path']))
+        if tracked:
+            for _, inode in tree.files(copied):
+                reference_blocks(inode['blocks'], inode['replication'], inode['id'])
+
+def file_inode_for_write(tree, parts):
+    return tree.lookup(parts) or tree.create_file(parts)
+
+def packed_range(inode):
+    # (container block_id, offset, length) of a packed file, whose only block is its container range
+    blocks = inode.get('blocks', [])
+    if len(blocks) == 1 and 'offset' in blocks[0]:
+        return blocks[0]['block_id'], blocks[0]['offset'], blocks[0]['size']
+    return None
+
+def can_write_file(parts):
+    inode = namespace.lookup(parts)
+    return inode['type'] == 'file' if inode else namespace.can_create(parts)
+
+def replace_blocks(inode, blocks, tracked=True):
+    if tracked:
+        release_blocks(inode['blocks'], inode['replication'], inode['id'])
+    inode['blocks'] = blocks
+    inode['generation'] = inode.get('generation', 0) + 1
+
+def reference_blocks(blocks, replication, inode_id):
+    replication = replication or cp.replication_factor
+    for block in blocks:
+        block_refs[block['block_id']] += 1
+        factors = replication_refs.setdefault(block['block_id'], Counter())
+        factors[replication] += 1
+        expected_replication[block['block_id']] = max(factors)
+        if 'offset' in block:
+            container = containers.setdefault(block['block_id'], {'size': block['container_size'], 'entries': {}})
+            container['entries'][inode_id] = (block['offset'], block['size'])
+        if block.get('fingerprint'):
+            fingerprints.setdefault(block['fingerprint'], block)
+
+def release_blocks(blocks, replication, inode_id):
+    replication = replication or cp.replication_factor
+    for block in blocks:
+        block_refs[block['block_id']] -= 1
+        factors = replication_refs.get(block['block_id'], Counter())
+        factors[replication] -= 1
+        if factors[replication] <= 0:
+            del factors[replication]
+        if 'offset' in block:
+            containers[block['block_id']]['entries'].pop(inode_id, None)
+        if factors:
+            expected_replication[block['block_id']] = max(factors)
+        if block_refs[block['block_id']] <= 0:
+            del block_refs[block['block_id']]
+            expected_replication.pop(block['block_id'], None)
+            replication_refs.pop(block['block_id'], None)
+            containers.pop(block['block_id'], None)
+            if fingerprints.get(block.get('fingerprint'), {}).get('block_id') == block['block_id']:
+                del fingerprints[block['fingerprint']]
+            released_blocks.append(block['block_id'])
+
+def update_metadata(blocks):
+    # Appends a batch of blocks to their files as a single edit, so the whole batch costs one fsync
+    blocks = [{'file_path': join_path(split_path(block['file_path'])), 'block_id': block['block_id'],
+               'data_node_id': block['data_node_id']} for block in blocks]
+    with namespace_lock.write():
+        # Paths created earlier in the same batch are files by the time their later blocks apply
+        created = set()
+        for block in blocks:
+            parts = split_path(block['file_path'])
+            if block['file_path'] not in created and not can_write_file(parts):
+                return block['file_path']
+            created.add(block['file_path'])
+        txid = log_edit({'op': 'add_blocks', 'blocks': blocks})
+    edit_log.sync(txid)
+    return None
+
+@app.route('/update_metadata', methods=['POST'])
+def update_metadata_route():
+    data = request.json
+    # Either one block as file_path/block_id/data_node_id or a batch under 'blocks'
+    blocks = data.get('blocks') if 'blocks' in data else [data]
+    if not blocks or not all(block.get('file_path') and block.get('block_id') for block in blocks):
+        return jsonify({'message': 'Invalid block list'}), 400
+
+    failed_path = update_metadata(blocks)
+    if failed_path is None:
+        return jsonify({'message': f'Metadata updated for {len(blocks)} blocks'}), 200
+    else:
+        return jsonify({'message': f'{failed_path} is not a file'}), 400
+
+def block_entry(block):
+    entry = {'block_id': block['block_id'], 'data_node_id': block['data_node_id'],
+             'replicas': block.get('replicas', [block['data_node_id']]), 'size': block.get('size')}
+    if block.get('codec'):
+        # size is the block's length once decompressed, stored_size what the Data Nodes hold
+        entry.update(codec=block['codec'], stored_size=block.get('stored_size'))
+    if block.get('fingerprint'):
+        entry['fingerprint'] = block['fingerprint']
+    return entry
+
+def commit_file(file_path, blocks, replication):
+    # Returns None, or the error reply saying why the commit was refused
+    parts = split_path(file_path)
+    # Blocks the client reused from /lookup_fingerprints instead of uploading
+    reused = {block['block_id'] for block in blocks if block.get('deduplicated')}
+    blocks = [block_entry(block) for block in blocks]
+    with namespace_lock.write():
+        if not can_write_file(parts):
+            return {'message': f'{file_path} is not a file'}
+        # A reused block whose last file went away since the lookup is already being deleted. The code
+        # tells the client to upload just these blocks again and keep the rest
+        stale = sorted(block_id for block_id in reused if block_id not in block_refs)
+        if stale:
+            return {'code': 'stale_blocks', 'stale_blocks': stale,
+                    'message': f'Reused blocks {", ".join(stale)} no longer exist'}
+        txid = log_edit({'op': 'commit_file', 'file_path': join_path(parts), 'blocks': blocks, 'replication': replication})
+    edit_log.sync(txid)
+    record_replicas(blocks)
+    delete_released_blocks()
+    return None
+
+def record_replicas(blocks):
+    with block_lock:
+        for block in blocks:
+            # The pipeline acknowledged these replicas as persisted; record them now rather than
+            # wait for the Data Nodes' batched block reports
+            for data_node_id in block['replicas']:
+                if data_node_id in data_nodes:
+                    add_block_location(block['block_id'], data_node_id)
+            # A pipeline that lost a replica part-way still commits; recover the missing copies
+            check_replication(block['block_id'])
+
+@app.route('/commit_file', methods=['POST'])
+def commit_file_route():
+    data = request.json
+    file_path = data.get('file_path')
+    blocks = data.get('blocks')
+    replication = data.get('replication') or cp.replication_factor
+
+    if file_path and isinstance(blocks, list):
+        error = commit_file(file_path, blocks, replication)
+        if error is None:
+            return jsonify({'status': 'success', 'message': f'Committed {len(blocks)} blocks for {file_path}'}), 200
+        else:
+            return jsonify(dict(error, status='error')), 409
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid file path or block list'}), 400
+
+@app.route('/lookup_fingerprints', methods=['POST'])
+def lookup_fingerprints():
+    # Entries of live blocks with the given content fingerprints, with their current replicas, so a
+    # client can commit them instead of uploading the same data again
+    data = request.json
+    found = {}
+    with namespace_lock.read():
+        with block_lock:
+            for fingerprint in data.get('fingerprints', []):
+                block = fingerprints.get(fingerprint)
+                replicas = block_map.get(block['block_id']) if block else None
+                if replicas:
+                    found[fingerprint] = dict(block, replicas=sorted(replicas))
+    return jsonify({'status': 'success', 'blocks': found})
+
+def container_block(container):
+    return {'block_id': container['block_id'], 'data_node_id': container['data_node_id'],
+            'replicas': container.get('replicas', [container['data_node_id']]), 'size': container['size']}
+
+def commit_packed(container, files, replication):
+    # Small files packed into one container block, committed as a single edit. Each file's only
+    # block is its (container, offset, length) range
+    container = container_block(container)
+    files = [{'file_path': join_path(split_path(packed['file_path'])), 'offset': packed['offset'],
+              'length': packed['length']} for packed in files]
+    with namespace_lock.write():
+        for packed in files:
+            if not can_write_file(split_path(packed['file_path'])):
+                return packed['file_path']
+        txid = log_edit({'op': 'commit_packed', 'container': container, 'files': files, 'replication': replication})
+    edit_log.sync(txid)
+    record_replicas([container])
+    delete_released_blocks()
+    return None
+
+@app.route('/commit_packed', methods=['POST'])
+def commit_packed_route():
+    data = request.json
+    container = data.get('container')
+    files = data.get('files')
+    replication = data.get('replication') or cp.replication_factor
+
+    if not container or not files or not all(packed.get('file_path') for packed in files):
+        return jsonify({'status': 'error', 'message': 'Invalid container or file list'}), 400
+    failed_path = commit_packed(container, files, replication)
+    if failed_path is None:
+        return jsonify({'status': 'success', 'message': f"Committed {len(files)} files packed into {container['block_id']}"}), 200
+    else:
+        return jsonify({'status': 'error', 'message': f'{failed_path} is not a file'}), 409
+
+@app.route('/containers', methods=['GET'])
+def list_containers():
+    # Containers whose live entries fill less than max_live_ratio of them, for compaction
+    data = request.get_json(silent=True) or {}
+    max_live_ratio = data.get('max_live_ratio', cp.compaction_threshold)
+    limit = data.get('limit', cp.list_page_size)
+
+    candidates = []
+    with namespace_lock.read():
+        for block_id, container in containers.items():
+            live_bytes = sum(length for _, length in container['entries'].values())
+            if live_bytes < max_live_ratio * container['size']:
+                candidates.append({'block_id': block_id, 'size': container['size'], 'live_bytes': live_bytes,
+                                   'replication': expected_replication.get(block_id),
+                                   'entries': [{'inode_id': inode_id, 'offset': offset, 'length': length}
+                                               for inode_id, (offset, length) in container['entries'].items()]})
+                if len(candidates) >= limit:
+                    break
+        with block_lock:
+            for candidate in candidates:
+                candidate['locations'] = block_locations({'block_id': candidate['block_id'], 'replicas': []})
+    return jsonify({'status': 'success', 'containers': candidates})
+
+@app.route('/repack', methods=['POST'])
+def repack():
+    # Points the live entries of a compacted container at their copies in a new one; the old
+    # container is deleted once nothing references it
+    data = request.json
+    old_block_id = data.get('old_block_id')
+    container = data.get('container')
+    entries = data.get('entries')
+    if not old_block_id or not container or not isinstance(entries, list):
+        return jsonify({'status': 'error', 'message': 'Invalid repack request'}), 400
+    container = container_block(container)
+
+    with namespace_lock.write():
+        live = containers.get(old_block_id, {}).get('entries', {})
+        entries = [entry for entry in entries if live.get(entry['inode_id']) == (entry['offset'], entry['length'])]
+        txid = log_edit({'op': 'repack', 'old_block_id': old_block_id, 'container': container, 'entries': entries}) if entries else None
+    if txid is not None:
+        edit_log.sync(txid)
+    record_replicas([container])
+    with block_lock:
+        # Nothing was left to move, so the new container is garbage already
+        delete_block_replicas([container['block_id']])
+    delete_released_blocks()
+    return jsonify({'status': 'success', 'repacked': len(entries)})
+
+def placement_cost(data_node):
+    # Busy, slow and nearly full Data Nodes cost more; unreported capacity counts as empty
+    load = data_node.in_flight_writes + data_node.pending_writes
+    free_fraction = data_node.free_space / data_node.capacity if data_node.capacity else 1.0
+    return (1 + load) * (1 + data_node.write_latency) / max(free_fraction, 0.01)
+
+def choose_targets(replication, exclude, block_size=cp.block_size):
+    candidates = [data_node for data_node_id, data_node in data_nodes.items()
+                  if data_node_id not in exclude and (data_node.free_space is None or data_node.free_space >= block_size)]
+    targets = []
+    used_racks = set()
+    while candidates and len(targets) < replication:
+        # Spread replicas over racks first, then fill with the cheapest remaining nodes
+        on_new_rack = [data_node for data_node in candidates if data_node.rack not in used_racks]
+        data_node = min(on_new_rack or candidates, key=placement_cost)
+        candidates.remove(data_node)
+        targets.append(data_node)
+        used_racks.add(data_node.rack)
+        data_node.pending_writes += 1
+    return targets
+
+@app.route('/allocate_block', methods=['POST'])
+def allocate_block():
+    data = request.json
+    replication = data.get('replication') or cp.replication_factor
+    exclude = set(data.get('exclude', []))
+
+    with block_lock:
+        targets = choose_targets(replication, exclude)
+    if targets:
+        block_id = f'blk_{uuid.uuid4().hex}'
+        return jsonify({'status': 'success', 'block_id': block_id, 'targets': [data_node.serialize() for data_node in targets]})
+    else:
+        return jsonify({'status': 'error', 'message': 'No Data Nodes available'}), 503
+
+data_nodes = {}
+
+# Data Nodes are declared dead heartbeat_timeout seconds after their last heartbeat
+liveness = TimingWheel(1, cp.heartbeat_timeout, time.time())
+heartbeat_age = metrics.Gauge('namenode_data_node_heartbeat_age_seconds', 'Seconds since each live Data Node last sent a heartbeat',
+                              ('data_node',), function=lambda: {(str(data_node.id),): time.time() - data_node.last_ping_time
+                                                                for data_node in list(data_nodes.values())})
+
+def expire_data_nodes():
+    while True:
+        time.sleep(1)
+        for data_node_id in liveness.advance(time.time()):
+            with block_lock:
+                if data_node_id in data_nodes:
+                    handle_data_node_failure(data_node_id)
+                    del data_nodes[data_node_id]
+
+
+# Start the Data Node liveness thread
+liveness_thread = threading.Thread(target=expire_data_nodes)
+liveness_thread.daemon = True
+liveness_thread.start()
+
+# Define connected_clients globally
+connected_clients = {}
+
+def check_client_health():
+    while True:
+        current_time = time.time()
+        for client_id, last_ping_time in list(connected_clients.items()):
+            if current_time - last_ping_time > 60:
+                log.info("Client %s is considered offline", client_id)
+                del connected_clients[client_id]
+        time.sleep(30)
+
+# Start the client health check thread
+health_check_thread = threading.Thread(target=check_client_health)
+health_check_thread.daemon = True
+health_check_thread.start()
+
+@app.route('/ping', methods=['POST'])
+def client_ping():
+    client_id = request.json.get('client_id')
+    if client_id:
+        connected_clients[client_id] = time.time()
+        return jsonify({'status': 'success'})
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid client ID'}), 400
+
+@app.route('/create_file', methods=['POST'])
+def create_new_file():
+    data = request.json
+    file_path = data.get('file_path')
+    if file_path:
+        # Check if the file already exists
+        file_id = create_file(file_path)
+        if file_id:
+            return jsonify({'status': 'success', 'file_id': file_id})
+        else:
+            return jsonify({'status': 'error', 'message': 'File already exists'}), 400
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
+
+# Function to create a new file in metadata
+def create_file(file_path):
+    parts = split_path(file_path)
+    with namespace_lock.write():
+        if not namespace.can_create(parts):
+            return None
+        txid = log_edit({'op': 'create', 'file_path': join_path(parts)})
+        file_id = namespace.lookup(parts)['id']
+    edit_log.sync(txid)
+    return file_id
+
+@app.route('/create_directory', methods=['POST'])
+def create_directory():
+    data = request.json
+    directory_path = data.get('directory_path')
+
+    if directory_path:
+        parts = split_path(directory_path)
+        with namespace_lock.write():
+            created = namespace.can_create(parts)
+            if created:
+                txid = log_edit({'op': 'mkdir', 'path': join_path(parts)})
+        if created:
+            edit_log.sync(txid)
+            return jsonify({'status': 'success', 'message': f'Directory {directory_path} created successfully'})
+        else:
+            return jsonify({'status': 'error', 'message': f'{directory_path} already exists'}), 400
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid directory path'}), 400
+
+@app.route('/get_file_metadata', methods=['GET'])
+def get_file_metadata():
+    data = request.json
+    file_path = data.get('file_path')
+    file_path = r"{}".format(file_path)
+
+    # Optional window of the block list, for clients that fetch locations ahead of a sequential read
+    start_block = data.get('start_block', 0)
+    num_blocks = data.get('num_blocks')
+
+    if file_path:
+        with namespace_lock.read():
+            inode = namespace.lookup(split_path(file_path))
+            if inode and inode['type'] == 'file':
+                version = {'id': inode['id'], 'generation': inode.get('generation', 0)}
+                # The client's cached copy is still current: renew its lease without resending the blocks
+                if data.get('file_id') == version['id'] and data.get('generation') == version['generation']:
+                    return jsonify({'status': 'not_modified', 'lease': cp.metadata_lease, **version})
+                blocks = inode['blocks'][start_block:None if num_blocks is None else start_block + num_blocks]
+                file_metadata = dict(inode, start_block=start_block, num_blocks=len(inode['blocks']), **version)
+                with block_lock:
+                    file_metadata['blocks'] = [dict(block, locations=block_locations(block)) for block in blocks]
+        if inode and inode['type'] == 'file':
+            return jsonify({'status': 'success', 'metadata': file_metadata, 'lease': cp.metadata_lease})
+        else:
+            return jsonify({'status': 'error', 'message': 'File not found'}), 404
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
+
+
+def block_locations(block):
+    # Fall back to the replicas recorded at commit until the Data Nodes have reported the block
+    replicas = block_map.get(block['block_id']) or block.get('replicas', [block.get('data_node_id')])
+    return [data_nodes[data_node_id].serialize() for data_node_id in replicas if data_node_id in data_nodes]
+
+@app.route('/delete_file', methods=['POST'])
+def delete_file():
+    data = request.json
+    file_path = data.get('file_path')
+
+    if file_path:
+        delete_status = delete_file_from_metadata(file_path)
+        if delete_status:
+            return jsonify({'status': 'success', 'message': f'File {file_path} deleted successfully'})
+        else:
+            return jsonify({'status': 'error', 'message': f'File {file_path} not found'}), 404
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid file path'}), 400
+
+# Function to delete a file from metadata
+def delete_file_from_metadata(file_path):
+    parts = split_path(file_path)
+    with namespace_lock.write():
+        found = bool(parts) and namespace.lookup(parts) is not None
+        if found:
+            txid = log_edit({'op': 'delete', 'file_path': join_path(parts)})
+    if found:
+        log.debug("Deleted %s", file_path)
+        edit_log.sync(txid)
+        delete_released_blocks()
+        return True
+    else:
+        return False
+
+@app.route('/move_file', methods=['POST'])
+def move_file():
+    data = request.json
+    src_path = data.get('src_path')
+    dest_path = data.get('dest_path')
+
+    if src_path and dest_path:
+        move_status = move_file_in_metadata(src_path, dest_path)
+        if move_status:
+            return jsonify({'status': 'success', 'message': f'File moved from {src_path} to {dest_path}'})
+        else:
+            return jsonify({'status': 'error', 'message': f'Error moving file or file not found'}), 404
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid source or destination path'}), 400
+
+# Function to move a file in metadata
+def move_file_in_metadata(src_path, dest_path):
+    # Checking the destination and moving happen under one write lock, so no other request can interleave
+    with namespace_lock.write():
+        src_parts, dest_parts = resolve_destination(src_path, dest_path)
+        if dest_parts:
+            # Relinks the source inode under its new parent, whatever the size of its subtree
+            txid = log_edit({'op': 'move', 'src_path': join_path(src_parts), 'dest_path': join_path(dest_parts)})
+    if dest_parts:
+        edit_log.sync(txid)
+        return True
+    else:
+        return False
+
+def resolve_destination(src_path, dest_path):
+    # Like mv and cp: a destination that is a directory receives the source under its own name
+    src_parts = split_path(src_path)
+    dest_parts = split_path(dest_path)
+    if not src_parts or not namespace.lookup(src_parts):
+        return src_parts, None
+    dest_inode = namespace.lookup(dest_parts)
+    if dest_inode and dest_inode['type'] == 'directory':
+        dest_parts = dest_parts + [src_parts[-1]]
+    if not namespace.can_create(dest_parts) or dest_parts[:len(src_parts)] == src_parts:
+        return src_parts, None
+    return src_parts, dest_parts
+
+
+@app.route('/copy_file', methods=['POST'])
+def copy_file():
+    data = request.json
+    src_path = data.get('src_path')
+    dest_path = data.get('dest_path')
+
+    if src_path and dest_path:
+        copy_status = copy_file_in_metadata(src_path, dest_path)
+        if copy_status:
+            return jsonify({'status': 'success', 'message': f'File copied from {src_path} to {dest_path}'}), 200
+        else:
+            return jsonify({'status': 'error', 'message': f'Error copying file or file not found'}), 404
+    else:
+        return jsonify({'status': 'error', 'message': 'Invalid source or destination path'}), 400
+
+# Function to copy a file in metadata
+def copy_file_in_metadata(src_path, dest_path):
+    with namespace_lock.write():
+        src_parts, dest_parts = resolve_destination(src_path, dest_path)
+        if dest_parts:
+            txid = log_edit({'op': 'copy', 'src_path': join_path(src_parts), 'dest_path': join_path(dest_parts)})
+    if dest_parts:
+        log.debug("Copied %s to %s", src_path, dest_path)
+        edit_log.sync(txid)
+        return True
+    else:
+        return False
+
+
+# IDs survive a Data Node's death so it gets its block directory back when it returns
+data_node_ids = {}
+
+def assign_data_node_id(host, port, requested_id):
+    address = (host, port)
+    if address not in data_node_ids:
+        if requested_id and requested_id not in data_node_ids.values():
+            data_node_ids[address] = requested_id
+        else:
+            data_node_ids[address] = max(data_node_ids.values(), default=0) + 1
+    return data_node_ids[address]
+
+@app.route('/register', methods=['POST'])
+def register_data_node():
+    global data_nodes  # Add this line to reference the global variable
+    data = request.json
+    if 'host' in data and 'port' in data:
+        if 'data_nodes' not in globals():
+            data_nodes = {}
+        with block_lock:
+            data_node_id = assign_data_node_id(data['host'], data['port'], data.get('id'))
+            if data_node_id not in data_nodes:
+                data_nodes[data_node_id] = DataNode(data_node_id, data['host'], data['port'], data.get('rack'))
+            data_node = data_nodes[data_node_id]
+            data_node.update_load(data)
+            data_node.last_ping_time = time.time()
+            liveness.touch(data_node_id, data_node.last_ping_time)
+        log.info("Registered Data Node %s at %s:%s", data_node.id, data_node.host, data_node.port,
+                 extra={'data_node_id': data_node.id, 'rack': data_node.rack})
+        return jsonify({'status': 'success', 'data_node': data_node.serialize()})
+    else:
+        log.warning("Invalid Data Node registration: %s", data)
+        return jsonify({'status': 'error', 'message': 'Invalid data node information'}), 400
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    data = request.json
+    data_node_id = data.get('data_node_id')
+    with block_lock:
+        if data_node_id not in data_nodes:
+            # Declared dead, or this NameNode restarted: the Data Node registers and reports its blocks again
+            return jsonify({'reregister': True, 'commands': []})
+
+        data_node = data_nodes[data_node_id]
+        data_node.last_ping_time = time.time()
+        liveness.touch(data_node_id, data_node.last_ping_time)
+        data_node.update_load(data.get('load', {}))
+
+        for ack in data.get('acks', []):
+            if ack['command'] == 'replicate' and ack['status'] != 'done' and ack['block_id'] in pending_replications:
+                # Reschedule a failed copy now instead of waiting for replication_timeout
+                del pending_replications[ack['block_id']]
+                check_replication(ack['block_id'])
+
+        commands = pending_commands.pop(data_node_id, [])
+    return jsonify({'reregister': False, 'commands': commands})
+
+@app.route('/metadata', methods=['GET'])
+def get_metadata():
+    with block_lock:
+        metadata = {'data_nodes': [node.serialize() for node in data_nodes.values()]}
+    return jsonify(metadata)
+
+
+
+# block_id -> IDs of the Data Nodes holding a replica; the reverse map is DataNode.blocks
+block_map = {}
+
+def add_block_location(block_id, data_node_id):
+    block_map.setdefault(block_id, set()).add(data_node_id)
+    data_nodes[data_node_id].blocks.add(block_id)
+    if block_id in pending_replications and len(block_map[block_id]) >= expected_replication.get(block_id, 0):
+        del pending_replications[block_id]
+        replication_stats['completed'] += 1
+        recent_replications.append(time.time())
+    release_corrupt_replicas(block_id)
+
+# block_id -> IDs of the Data Nodes keeping a quarantined corrupt replica of it
+corrupt_replicas = {}
+
+def release_corrupt_replicas(block_id):
+    # A quarantined replica is only deleted once the block has all its good replicas again, or no file
+    # needs it any more; until then it is what is left to recover from
+    holders = corrupt_replicas.get(block_id)
+    if not holders:
+        return
+    expected = expected_replication.get(block_id)
+    if expected is not None and len(block_map.get(block_id, ())) < expected:
+        return
+    for data_node_id in holders:
+        if data_node_id in data_nodes:
+            pending_commands[data_node_id].append({'command': 'delete', 'block_id': block_id, 'quarantined': True})
+    del corrupt_replicas[block_id]
+
+def remove_block_location(block_id, data_node_id):
+    replicas = block_map.get(block_id)
+    if replicas is not None:
+        replicas.discard(data_node_id)
+        if not replicas:
+            del block_map[block_id]
+    data_nodes[data_node_id].blocks.discard(block_id)
+
+def remove_data_node_locations(data_node_id):
+    # Only touches the blocks on the node, not the whole namespace
+    lost_blocks = list(data_nodes[data_node_id].blocks)
+    for block_id in lost_blocks:
+        remove_block_location(block_id, data_node_id)
+    return lost_blocks
+
+@app.route('/block_report', methods=['POST'])
+def block_report():
+    # Full report, sent when a Data Node registers and every block_report_interval seconds
+    data = request.json
+    data_node_id = data.get('data_node_id')
+    reported = set(data.get('blocks', []))
+    # block_id -> seconds since the replica was written
+    ages = data.get('ages', {})
+    # The read lock keeps block_refs still while the report is checked against it
+    with namespace_lock.read(), block_lock:
+        if data_node_id not in data_nodes:
+            return jsonify({'status': 'error', 'message': f'DataNode {data_node_id} not registered'}), 404
+
+        # Replicas no file references: uploads that failed or were abandoned before their commit, copies
+        # left by a broken pipeline, or blocks whose delete was lost in a crash. Younger ones may still be
+        # waiting for their commit, and released blocks are deleted once their edit is synced
+        releasing = {block_id for _, block_ids in pending_deletions for block_id in block_ids}
+        orphans = {block_id for block_id in reported
+                   if block_id not in block_refs and block_id not in releasing
+                   and ages.get(block_id, 0) >= cp.orphan_block_grace}
+        known = data_nodes[data_node_id].blocks
+        for block_id in known - reported:
+            remove_block_location(block_id, data_node_id)
+            check_replication(block_id)
+        for block_id in reported - known - orphans:
+            add_block_location(block_id, data_node_id)
+        for block_id in orphans:
+            pending_commands[data_node_id].append({'command': 'delete', 'block_id': block_id})
+        for block_id in data.get('corrupt', []):
+            corrupt_replicas.setdefault(block_id, set()).add(data_node_id)
+            release_corrupt_replicas(block_id)
+    log.info("Block report from Data Node %s: %d blocks, %d orphaned", data_node_id, len(reported), len(orphans),
+             extra={'data_node_id': data_node_id, 'blocks': len(reported), 'orphans': len(orphans)})
+    return jsonify({'status': 'success'})
+
+@app.route('/incremental_block_report', methods=['POST'])
+def incremental_block_report():
+    data = request.json
+    data_node_id = data.get('data_node_id')
+    with block_lock:
+        if data_node_id not in data_nodes:
+            return jsonify({'status': 'error', 'message': f'DataNode {data_node_id} not registered'}), 404
+
+        for block_id in data.get('added', []):
+            add_block_location(block_id, data_node_id)
+        for block_id in data.get('deleted', []):
+            remove_block_location(block_id, data_node_id)
+            check_replication(block_id)
+    return jsonify({'status': 'success'})
+
+@app.route('/report_bad_blocks', methods=['POST'])
+def report_bad_blocks():
+    # Replicas that failed checksum verification; the Data Node has quarantined them
+    data = request.json
+    data_node_id = data.get('data_node_id')
+    with block_lock:
+        if data_node_id not in data_nodes:
+            return jsonify({'status': 'error', 'message': f'DataNode {data_node_id} not registered'}), 404
+
+        for block_id in data.get('blocks', []):
+            log.warning("Corrupt replica of block %s on Data Node %s", block_id, data_node_id,
+                        extra={'block_id': block_id, 'data_node_id': data_node_id})
+            remove_block_location(block_id, data_node_id)
+            corrupt_replicas.setdefault(block_id, set()).add(data_node_id)
+            check_replication(block_id)
+            release_corrupt_replicas(block_id)
+    return jsonify({'status': 'success'})
+
+class UnderReplicatedBlocks:
+    # Priority queue keyed by live replica count, so blocks one failure away from loss go first
+    def __init__(self):
+        self.heap = []
+        self.priorities = {}
+        self.counter = itertools.count()
+
+    def add(self, block_id, live_replicas):
+        # Re-pushing with a better priority leaves a stale entry that pop() skips
+        if self.priorities.get(block_id, float('inf')) > live_replicas:
+            self.priorities[block_id] = live_replicas
+            heapq.heappush(self.heap, (live_replicas, next(self.counter), block_id))
+
+    def pop(self):
+        while self.heap:
+            live_replicas, _, block_id = heapq.heappop(self.heap)
+            if self.priorities.get(block_id) == live_replicas:
+                del self.priorities[block_id]
+                return block_id
+        return None
+
+    def __len__(self):
+        return len(self.priorities)
+
+under_replicated = UnderReplicatedBlocks()
+# block_id -> (deadline, source Data Node ID, target Data Node IDs) for copies handed out
+pending_replications = {}
+# Data Node ID -> commands delivered with the next ping response
+pending_commands = defaultdict(list)
+replication_stats = {'scheduled': 0, 'completed': 0, 'timed_out': 0}
+recent_replications = deque()
+
+def check_replication(block_id):
+    expected = expected_replication.get(block_id)
+    if expected is None or block_id in pending_replications:
+        return
+    live_replicas = len(block_map.get(block_id, ()))
+    if live_replicas == 0:
+        log.error("Block %s has no live replicas", block_id, extra={'block_id': block_id})
+    elif live_replicas < expected:
+        under_replicated.add(block_id, live_replicas)
+
+def schedule_replication():
+    now = time.time()
+    for block_id, (deadline, source_id, target_ids) in list(pending_replications.items()):
+        if now > deadline:
+            del pending_replications[block_id]
+            replication_stats['timed_out'] += 1
+            check_replication(block_id)
+
+    # Copies in progress count against both ends of the transfer
+    transfers = Counter()
+    for deadline, source_id, target_ids in pending_replications.values():
+        transfers[source_id] += 1
+        transfers.update(target_ids)
+
+    deferred = []
+    while len(under_replicated):
+        block_id = under_replicated.pop()
+        replicas = block_map.get(block_id, set())
+        missing = expected_replication.get(block_id, 0) - len(replicas)
+        if missing <= 0 or not replicas:
+            continue
+
+        sources = [data_nodes[data_node_id] for data_node_id in replicas
+                   if data_node_id in data_nodes and transfers[data_node_id] < cp.max_replication_streams]
+        busy = {data_node_id for data_node_id, count in transfers.items() if count >= cp.max_replication_streams}
+        targets = choose_targets(missing, replicas | busy) if sources else []
+        if not targets:
+            deferred.append((block_id, len(replicas)))
+            continue
+
+        source = min(sources, key=lambda data_node: transfers[data_node.id])
+        pending_commands[source.id].append({'command': 'replicate', 'block_id': block_id,
+                                            'targets': [f'{target.host}:{target.port}' for target in targets]})
+        pending_replications[block_id] = (now + cp.replication_timeout, source.id, [target.id for target in targets])
+        replication_stats['scheduled'] += 1
+        transfers[source.id] += 1
+        transfers.update(target.id for target in targets)
+
+    for block_id, live_replicas in deferred:
+        under_replicated.add(block_id, live_replicas)
+
+def replication_monitor():
+    while True:
+        time.sleep(cp.replication_interval)
+        try:
+            with block_lock:
+                schedule_replication()
+        except Exception:
+            log.exception("Replication scheduling failed")
+
+# Start the re-replication scheduler thread
+replication_thread = threading.Thread(target=replication_monitor)
+replication_thread.daemon = True
+replication_thread.start()
+
+@app.route('/replication_status', methods=['GET'])
+def replication_status():
+    # Blocks per second re-replicated over the last minute
+    with block_lock:
+        while recent_replications and recent_replications[0] < time.time() - 60:
+            recent_replications.popleft()
+        status = {'under_replicated': len(under_replicated),
+                  'pending_replications': len(pending_replications),
+                  'recovery_rate': len(recent_replications) / 60,
+                  **replication_stats}
+    return jsonify(status)
+
+def handle_data_node_failure(offline_data_node_id):
+    lost_blocks = remove_data_node_locations(offline_data_node_id)
+    log.warning("Data Node %s is considered dead, %d blocks lost a replica", offline_data_node_id, len(lost_blocks),
+                extra={'data_node_id': offline_data_node_id, 'lost_blocks': len(lost_blocks)})
+    pending_commands.pop(offline_data_node_id, None)
+    for block_id in lost_blocks:
+        check_replication(block_id)
+    return lost_blocks
+
+def resolve_file_path(file_path):
+    with namespace_lock.read():
+        inode = namespace.lookup(split_path(file_path))
+    if inode and inode['type'] == 'file':
+        data_blocks = inode['blocks']
+        return data_blocks
+    else:
+        return None
+
+def send_data_block_to_client(file_path):
+    data_nodes_metadata = resolve_file_path(file_path)
+    log.debug("Sending Data Node metadata for file %s to the client: %s", file_path, data_nodes_metadata)
+
+@app.route('/list_files', methods=['GET'])
+def list_files():
+    # Pages of up to `limit` entries after the `start_after` cursor, or one NDJSON stream with format=ndjson
+    directory_parts = split_path(request.args.get('path', '/'))
+    with namespace_lock.read():
+        directory = namespace.lookup(directory_parts)
+    if not directory or directory['type'] != 'directory':
+        return jsonify({'status': 'error', 'message': 'Directory not found'}), 404
+
+    try:
+        limit = min(int(request.args.get('limit', cp.list_page_size)), cp.max_list_page_size)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return jsonify({'status': 'error', 'message': 'Invalid limit'}), 400
+    recursive = request.args.get('recursive', 'true') != 'false'
+    stat = request.args.get('stat') == 'true'
+    prefix = request.args.get('prefix')
+    pattern = request.args.get('pattern')
+
+    # The walk starts at the names the prefix allows; the filter below still decides exact matches
+    within = prefix_parts(prefix, directory_parts) if prefix else []
+
+    start_after = split_path(request.args.get('start_after', ''))
+    if start_after[:len(directory_parts)] == directory_parts:
+        start_after = start_after[len(directory_parts):]
+    else:
+        start_after = []
+
+    def list_page(start_after, limit):
+        with namespace_lock.read():
+            entries = ((join_path(parts), inode) for parts, inode in
+                       namespace.iter_sorted(directory, directory_parts, start_after, recursive, within))
+            entries = ((path, inode) for path, inode in entries
+                       if (not prefix or path.startswith(prefix)) and (not pattern or fnmatch.fnmatchcase(path, pattern)))
+            page = [(path, list_entry(path, inode, stat)) for path, inode in itertools.islice(entries, limit + 1)]
+        next_cursor = page[limit - 1][0] if len(page) > limit else None
+        return [entry for _, entry in page[:limit]], next_cursor
+
+    if request.args.get('format') == 'ndjson':
+        def stream_entries(start_after):
+            # Take the read lock one page at a time so a slow reader never holds off writers
+            while True:
+                entries, next_cursor = list_page(start_after, cp.list_page_size)
+                for entry in entries:
+                    yield json.dumps(entry) + '\n'
+                if next_cursor is None:
+                    return
+                start_after = split_path(next_cursor)[len(directory_parts):]
+        return Response(stream_entries(start_after), mimetype='application/x-ndjson')
+
+    entries, next_cursor = list_page(start_after, limit)
+    return jsonify({'files': entries, 'next_cursor': next_cursor})
+
+def prefix_parts(prefix, directory_parts):
+    # Path parts below the listed directory that every path starting with prefix goes through, the
+    # last one a name prefix: '/d/ab' under '/d' gives ['ab']. Empty when the prefix doesn't narrow the walk
+    parts = prefix.split('/')
+    if parts[0] != '' or parts[1:len(directory_parts) + 1] != directory_parts:
+        return []
+    return parts[len(directory_parts) + 1:]
+
+def list_entry(path, inode, stat):
+    if not stat:
+        return path
+    if inode['type'] == 'directory':
+        return {'path': path, 'type': 'directory', 'id': inode['id'], 'num_children': len(inode['files'])}
+    sizes = [block.get('size') for block in inode['blocks']]
+    return {'path': path, 'type': 'file', 'id': inode['id'], 'num_blocks': len(sizes),
+            'size': sum(sizes) if None not in sizes else None, 'replication': inode['replication']}
+
+@app.route('/traverse_directory', methods=['POST'])
+def traverse_directory():
+    data = request.json
+    directory_path = data.get('directory_path', '/')
+    parts = split_path(directory_path)
+
+    with namespace_lock.read():
+        inode = namespace.lookup(parts)
+        tree = directory_tree(join_path(parts), inode) if inode and inode['type'] == 'directory' else None
+    if tree:
+        return jsonify({'status': 'success', 'tree': tree})
+    else:
+        return jsonify({'status': 'error', 'message': f'Directory {directory_path} not found'}), 404
+
+def directory_tree(name, inode):
+    if inode['type'] == 'file':
+        return {'name': name, 'type': 'file', 'id': inode['id'], 'num_blocks': len(inode['blocks'])}
+    children = [directory_tree(child_name, child) for child_name, child in sorted(inode['files'].items())]
+    return {'name': name, 'type': 'directory', 'id': inode['id'], 'children': children}
+
+
+if __name__ == '__main__':
+    setup_logging()
+    initialize_metadata()
+    app.run(host=cp.name_node_host, port=cp.name_node_port)
@@ -0,0 +1,136 @@
+import bisect
+import copy
+
+
+def split_path(path):
+    # Accept both '/' and '\' separators; empty and '.' components are dropped
+    return [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+
+
+def join_path(parts):
+    return '/' + '/'.join(parts)
+
+
+class Namespace:
+    # Directory tree of inodes; each directory maps child names to inodes, so resolving
+    # a path costs O(depth) and moving a subtree only relinks its root
+    def __init__(self, snapshot=None):
+        self.inodes = {}
+        self.next_inode_id = 1
+        if snapshot is None:
+            self.root = self.new_inode('directory')
+        else:
+            self.next_inode_id = snapshot['next_inode_id']
+            self.root = snapshot['root']
+            self.index(self.root)
+
+    def new_inode(self, inode_type):
+        inode = {'id': self.next_inode_id, 'type': inode_type}
+        if inode_type == 'directory':
+            inode['files'] = {}
+        else:
+            inode['blocks'] = []
+            inode['replication'] = None
+            # Bumped whenever the block list changes, so clients can validate cached locations
+            inode['generation'] = 0
+        self.inodes[inode['id']] = inode
+        self.next_inode_id += 1
+        return inode
+
+    def index(self, inode):
+        self.inodes[inode['id']] = inode
+        for child in inode.get('files', {}).values():
+            self.index(child)
+
+    def snapshot(self):
+        return {'next_inode_id': self.next_inode_id, 'root': self.root}
+
+    def lookup(self, parts):
+        inode = self.root
+        for part in parts:
+            if inode['type'] != 'directory' or part not in inode['files']:
+                return None
+            inode = inode['files'][part]
+        return inode
+
+    def can_create(self, parts):
+        # The path must be free and every existing ancestor must be a directory
+        if not parts:
+            return False
+        inode = self.root
+        for part in parts[:-1]:
+            inode = inode['files'].get(part)
+            if inode is None:
+                return True
+            if inode['type'] != 'directory':
+                return False
+        return parts[-1] not in inode['files']
+
+    def mkdirs(self, parts):
+        inode = self.root
+        for part in parts:
+            if part not in inode['files']:
+                inode['files'][part] = self.new_inode('directory')
+            inode = inode['files'][part]
+        return inode
+
+    def create_file(self, parts):
+        parent = self.mkdirs(parts[:-1])
+        inode = parent['files'][parts[-1]] = self.new_inode('file')
+        return inode
+
+    def remove(self, parts):
+        inode = self.lookup(parts[:-1])['files'].pop(parts[-1])
+        for _, child in self.walk(inode):
+            del self.inodes[child['id']]
+        return inode
+
+    def move(self, src_parts, dest_parts):
+        inode = self.lookup(src_parts[:-1])['files'].pop(src_parts[-1])
+        self.mkdirs(dest_parts[:-1])['files'][dest_parts[-1]] = inode
+        return inode
+
+    def copy(self, src_parts, dest_parts):
+        inode = copy.deepcopy(self.lookup(src_parts))
+        for _, child in self.walk(inode):
+            child['id'] = self.next_inode_id
+            self.inodes[child['id']] = child
+            self.next_inode_id += 1
+        self.mkdirs(dest_parts[:-1])['files'][dest_parts[-1]] = inode
+        return inode
+
+    def walk(self, inode, parts=()):
+        # Yields (path parts, inode) for the inode and everything below it
+        stack = [(list(parts), inode)]
+        while stack:
+            parts, inode = stack.pop()
+            yield parts, inode
+            if inode['type'] == 'directory':
+                for name, child in inode['files'].items():
+                    stack.append((parts + [name], child))
+
+    def iter_sorted(self, inode, parts=(), start_after=(), recursive=True, within=()):
+        # Depth-first in name order, resuming after start_after (path parts relative to inode).
+        # Only the directories along the cursor path are re-read to resume. within narrows the walk
+        # to exact names down its path, its last part being a name prefix
+        names = sorted(inode['files'])
+        start = bisect.bisect_left(names, start_after[0]) if start_after else 0
+        if within:
+            start = max(start, bisect.bisect_left(names, within[0]))
+        for name in names[start:]:
+            if within and not (name.startswith(within[0]) if len(within) == 1 else name == within[0]):
+                break
+            child = inode['files'][name]
+            child_parts = list(parts) + [name]
+            resume = start_after[1:] if start_after and name == start_after[0] else None
+            if resume is None:
+                if child['type'] == 'file' or not recursive:
+                    yield child_parts, child
+                if child['type'] == 'directory' and recursive:
+                    yield from self.iter_sorted(child, child_parts, within=within[1:])
+            elif child['type'] == 'directory' and recursive:
+                # The cursor is this directory or lies inside it
+                yield from self.iter_sorted(child, child_parts, resume, within=within[1:])
+
+    def files(self, inode, parts=()):
+        return ((parts, child) for parts, child in self.walk(inode, parts) if child['type'] == 'file')
@@ -0,0 +1,45 @@
+import sys
+import threading
+import time
+from collections import Counter
+from flask import Response, jsonify, request
+import config_param as cp
+
+
+def sample_stacks(seconds, interval):
+    # Samples every other thread's stack each interval; returns {collapsed stack: samples}
+    counts = Counter()
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def collapsed(counts, limit):
+    # Hottest stacks first, one "frame;frame;... count" line each, the input flamegraph.pl expects
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common(limit))
+
+
+def profile_args(args):
+    seconds = min(float(args.get('seconds', 5)), cp.profiler_max_seconds)
+    return seconds, float(args.get('interval', cp.profiler_interval)), int(args.get('limit', 100))
+
+
+def install(app):
+    # Opt-in: GET /debug/profile?seconds=5 samples the running server and returns its hot stacks
+    @app.route('/debug/profile', methods=['GET'])
+    def profile():
+        if not cp.profiler_enabled:
+            return jsonify({'status': 'error', 'message': 'Profiler is disabled'}), 404
+        seconds, interval, limit = profile_args(request.args)
+        return Response(collapsed(sample_stacks(seconds, interval), limit), mimetype='text/plain')
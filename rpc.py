@@ -0,0 +1,78 @@
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Request, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+import config_param as cp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = 'application/msgpack'
+
+# Keep-alive connections pooled per peer and shared by every thread in the process
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=cp.rpc_max_peers, pool_maxsize=cp.rpc_pool_size))
+if msgpack:
+    session.headers['Accept'] = f'{MSGPACK}, application/json'
+
+
+def call(method, url, payload=None, retries=cp.rpc_retries, timeout=cp.rpc_timeout, **kwargs):
+    # payload is a control message, sent as msgpack where available. Only pass retries to calls
+    # that are safe to repeat: a request that timed out may still have been applied
+    if payload is not None:
+        if msgpack:
+            kwargs['data'] = msgpack.packb(payload)
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **{'Content-Type': MSGPACK})
+        else:
+            kwargs['json'] = payload
+    for attempt in range(retries + 1):
+        try:
+            return session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(backoff(attempt))
+
+
+def backoff(attempt):
+    # Full jitter, so peers that failed together don't retry in lockstep
+    return random.uniform(0, min(cp.rpc_max_backoff, cp.rpc_base_backoff * 2 ** attempt))
+
+
+def get(url, payload=None, **kwargs):
+    return call('GET', url, payload, **kwargs)
+
+
+def post(url, payload=None, **kwargs):
+    return call('POST', url, payload, **kwargs)
+
+
+def decode(response):
+    if response.headers.get('Content-Type', '').startswith(MSGPACK):
+        return msgpack.unpackb(response.content)
+    return response.json()
+
+
+class RPCRequest(Request):
+    # request.json accepts msgpack bodies as well
+    def get_json(self, force=False, silent=False, cache=True):
+        if msgpack and self.mimetype == MSGPACK:
+            return msgpack.unpackb(self.get_data(cache=cache))
+        return super().get_json(force=force, silent=silent, cache=cache)
+
+
+class RPCJSONProvider(DefaultJSONProvider):
+    # jsonify answers in msgpack to callers that ask for it, and in JSON to everyone else
+    def response(self, *args, **kwargs):
+        if msgpack and has_request_context() and MSGPACK in request.headers.get('Accept', ''):
+            return self._app.response_class(msgpack.packb(self._prepare_response_obj(args, kwargs)), mimetype=MSGPACK)
+        return super().response(*args, **kwargs)
+
+
+def install(app):
+    app.request_class = RPCRequest
+    app.json = RPCJSONProvider(app)
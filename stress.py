@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from benchmark import default_settings
+
+# Mixed namespace operations from many threads against an in-process Name Node while checkpoints run.
+# Afterwards the last checkpoint plus the edit log must rebuild exactly the namespace and block
+# references the Name Node ended up with, and a fresh checkpoint must match it too.
+#   python stress.py --threads 32 --ops 500
+
+OPS = ('create', 'commit', 'commit_packed', 'move', 'copy', 'delete', 'mkdir', 'list')
+
+
+def write_config(base_dir):
+    # The repo's settings with its placeholders filled in, imported ahead of the repo's config_param.py
+    settings = dict(default_settings(), name_node_host=repr('127.0.0.1'), name_node_port='0',
+                    name_node_url=repr('http://127.0.0.1:0'), data_node_host=repr('127.0.0.1'), data_node_port='0',
+                    metadata_dir=repr(os.path.join(base_dir, 'metadata')),
+                    data_blocks_dir=repr(os.path.join(base_dir, 'blocks')), checkpoint_interval='3600')
+    with open(os.path.join(base_dir, 'config_param.py'), 'w', encoding='utf-8') as config_file:
+        config_file.writelines(f'{name} = {value}\n' for name, value in settings.items())
+    sys.path.insert(0, base_dir)
+
+
+def random_path(rng, options):
+    # Few enough names that threads keep running into each other's files and directories
+    depth = rng.randint(1, 3)
+    return '/' + '/'.join(f'n{rng.randrange(options.names)}' for _ in range(depth))
+
+
+def new_block(rng, options=None):
+    # With options, sometimes one of a few shared blocks, so files with different replication factors
+    # end up referencing the same block, as deduplicated uploads do
+    if options and rng.random() < 0.25:
+        block_id = f'blk_shared_{rng.randrange(options.names)}'
+    else:
+        block_id = f'blk_{rng.getrandbits(64):016x}'
+    return {'block_id': block_id, 'data_node_id': 1, 'replicas': [1], 'size': rng.randint(1, 1 << 20)}
+
+
+def run_op(http, rng, options):
+    op = rng.choice(OPS)
+    if op == 'create':
+        response = http.post('/create_file', json={'file_path': random_path(rng, options)})
+    elif op == 'commit':
+        blocks = [new_block(rng, options) for _ in range(rng.randint(0, 3))]
+        response = http.post('/commit_file', json={'file_path': random_path(rng, options), 'blocks': blocks,
+                                                   'replication': rng.randint(1, 3)})
+    elif op == 'commit_packed':
+        directory = random_path(rng, options)
+        offset = 0
+        files = []
+        for index in range(rng.randint(1, 4)):
+            length = rng.randint(1, 4096)
+            files.append({'file_path': f'{directory}/p{index}', 'offset': offset, 'length': length})
+            offset += length
+        response = http.post('/commit_packed', json={'container': dict(new_block(rng), size=offset), 'files': files,
+                                                     'replication': rng.randint(1, 3)})
+    elif op in ('move', 'copy'):
+        response = http.post(f'/{op}_file', json={'src_path': random_path(rng, options),
+                                                  'dest_path': random_path(rng, options)})
+    elif op == 'delete':
+        response = http.post('/delete_file', json={'file_path': random_path(rng, options)})
+    elif op == 'mkdir':
+        response = http.post('/create_directory', json={'directory_path': random_path(rng, options)})
+    else:
+        return op, list_pages(http, rng)
+    # Refusals (exists, not found, not a file) are expected; only server errors count as failures
+    return op, response.status_code < 500
+
+
+def list_pages(http, rng):
+    # Every page comes from its own read lock, but entries must still arrive in order without repeats
+    seen = []
+    cursor = None
+    while True:
+        query = {'path': '/', 'limit': rng.randint(1, 20)}
+        if cursor:
+            query['start_after'] = cursor
+        response = http.get('/list_files', query_string=query)
+        if response.status_code != 200:
+            return False
+        page = response.get_json()
+        seen += page['files']
+        cursor = page['next_cursor']
+        if cursor is None:
+            return seen == sorted(set(seen))
+
+
+def block_state(namenode):
+    return {'namespace': json.loads(json.dumps(namenode.namespace.snapshot())),
+            'block_refs': dict(namenode.block_refs),
+            'expected_replication': dict(namenode.expected_replication),
+            'replication_refs': {block_id: dict(factors) for block_id, factors in namenode.replication_refs.items()},
+            'containers': json.loads(json.dumps(namenode.containers))}
+
+
+def counted_refs(namenode):
+    # block_refs and expected_replication recomputed from the files in the namespace
+    refs = Counter()
+    replication = {}
+    for _, inode in namenode.namespace.files(namenode.namespace.root):
+        factor = inode['replication'] or namenode.cp.replication_factor
+        for block in inode['blocks']:
+            refs[block['block_id']] += 1
+            replication[block['block_id']] = max(replication.get(block['block_id'], 0), factor)
+    return dict(refs), replication
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent namespace stress test with checkpoint and replay checks')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=300, help='operations per thread')
+    parser.add_argument('--names', type=int, default=6, help='distinct names per path level')
+    parser.add_argument('--checkpoint-every', type=float, default=0.05, help='seconds between checkpoints')
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args()
+    seed = options.seed if options.seed is not None else random.randrange(1 << 32)
+
+    write_config(tempfile.mkdtemp(prefix='yadfs-stress-'))
+    import namenode
+    # Blocks here have no Data Nodes, which the Name Node would otherwise log as lost on every commit
+    logging.getLogger('namenode').setLevel(logging.CRITICAL)
+    namenode.initialize_metadata()
+
+    done = threading.Event()
+    checkpoints = 0
+    problems = []
+
+    def checkpointer():
+        nonlocal checkpoints
+        while not done.wait(options.checkpoint_every):
+            try:
+                namenode.save_metadata()
+            except Exception as e:
+                problems.append(f'checkpoint {checkpoints + 1} failed: {e!r}')
+                return
+            checkpoints += 1
+
+    def worker(thread):
+        rng = random.Random(seed + thread)
+        http = namenode.app.test_client()
+        return [run_op(http, rng, options) for _ in range(options.ops)]
+
+    checkpoint_thread = threading.Thread(target=checkpointer)
+    checkpoint_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=options.threads) as executor:
+            results = [result for results in executor.map(worker, range(options.threads)) for result in results]
+    finally:
+        done.set()
+        checkpoint_thread.join()
+    # One more worker once checkpoints have stopped, so the replay below always has edits to apply
+    results += worker(options.threads)
+
+    failures = Counter(op for op, ok in results if not ok)
+    problems += [f'{count} {op} operations failed' for op, count in failures.items()]
+    live = block_state(namenode)
+    refs, replication = counted_refs(namenode)
+    if refs != live['block_refs']:
+        problems.append('block_refs does not match the blocks the namespace references')
+    if replication != live['expected_replication']:
+        problems.append('expected_replication is not the highest factor among the files referencing each block')
+
+    # Everything before the last checkpoint comes from metadata.json, the rest from the edit log
+    txid = namenode.edit_log.txid
+    namenode.edit_log.sync(txid)
+    replayed_txid, replayed = namenode.load_namespace()
+    if replayed_txid != txid:
+        problems.append(f'replay stopped at txid {replayed_txid}, the log is at {txid}')
+    for name, value in block_state(namenode).items():
+        if value != live[name]:
+            problems.append(f'replaying the checkpoint and edit log gives a different {name}')
+
+    try:
+        namenode.save_metadata()
+        checkpoint_txid, snapshot = namenode.load_metadata()
+        if checkpoint_txid != txid or json.loads(json.dumps(snapshot.snapshot())) != live['namespace']:
+            problems.append('a checkpoint taken at the end does not match the namespace')
+    except Exception as e:
+        problems.append(f'the final checkpoint failed: {e!r}')
+
+    print(json.dumps({'seed': seed, 'threads': options.threads, 'operations': len(results),
+                      'by_op': Counter(op for op, _ in results), 'checkpoints': checkpoints, 'txid': txid,
+                      'files': sum(1 for _ in namenode.namespace.files(namenode.namespace.root)),
+                      'blocks': len(live['block_refs']),
+                      'replayed_edits': replayed, 'problems': problems}, indent=2))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+import math
+import threading
+
+
+class TimingWheel:
+    # Buckets deadlines by tick, so each advance costs O(expired) instead of O(tracked keys)
+    def __init__(self, tick, timeout, now):
+        self.tick = tick
+        self.timeout = timeout
+        # One more slot than the timeout spans, so a live deadline never shares a slot with the current tick
+        self.slots = [set() for _ in range(math.ceil(timeout / tick) + 2)]
+        self.deadline_ticks = {}
+        self.current_tick = int(now / tick)
+        self.lock = threading.Lock()
+
+    def touch(self, key, now):
+        deadline_tick = math.ceil((now + self.timeout) / self.tick)
+        with self.lock:
+            self._discard(key)
+            self.slots[deadline_tick % len(self.slots)].add(key)
+            self.deadline_ticks[key] = deadline_tick
+
+    def remove(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def advance(self, now):
+        expired = []
+        with self.lock:
+            target_tick = int(now / self.tick)
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                for key in [key for key in slot if self.deadline_ticks[key] <= self.current_tick]:
+                    self._discard(key)
+                    expired.append(key)
+        return expired
+
+    def __len__(self):
+        return len(self.deadline_ticks)
+
+    def _discard(self, key):
+        deadline_tick = self.deadline_ticks.pop(key, None)
+        if deadline_tick is not None:
+            self.slots[deadline_tick % len(self.slots)].discard(key)